@@ -0,0 +1,179 @@
+"""
+Build many books in one go: a list of book URLs, or every book linked from an author's page.
+
+All builds share one Fetcher, so one connection pool and one page cache, and
+like every Fetcher of the process it keeps to one politeness budget per host
+no matter how many books are built at once.
+Finished books are recorded in a journal, an interrupted run started again
+with the same journal skips them.
+
+    python batch.py <book url> [<book url> ...]
+    python batch.py --file urls.txt
+    python batch.py --author https://www.marxists.org/deutsch/archiv/marx-engels/index.htm
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from processer import from_url
+from fetcher import Fetcher
+from httpcache import HttpCache
+from progress import Progress
+from manifest import extract_book_links
+from charset import decode_html
+from zipwriter import PROFILES
+from buildcache import normalize_url
+
+# Books built at the same time, the fetcher still keeps requests per host within its budget
+DEFAULT_CONCURRENCY = 2
+
+
+class Journal:
+    """
+    Append-only log of finished books (one JSON object per line), so a run
+    can be resumed. The last entry for a URL wins.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by the interruption
+                    self.entries[entry['url']] = entry
+
+    def done(self, url):
+        return self.entries.get(url, {}).get('status') == 'done'
+
+    def record(self, url, status, **fields):
+        entry = dict(fields, url=url, status=status, time=time.time())
+        with self.lock:
+            self.entries[url] = entry
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+
+class BookProgress(Progress):
+    """Prefixes every line with the book it belongs to, books are built side by side"""
+
+    lock = threading.Lock()
+
+    def __init__(self, prefix, parent):
+        self.prefix = prefix
+        self.parent = parent
+
+    def publish(self, event):
+        if event['type'] in ('message', 'stage', 'error'):
+            with self.lock:
+                self.parent.publish(dict(event, text=f"{self.prefix} {event.get('text') or event.get('stage')}"))
+
+
+def default_journal(root_dir, key):
+    return Path(root_dir) / "cache" / "batch" / f"{hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]}.jsonl"
+
+
+def author_books(author_url, fetcher):
+    """URLs of all books linked from an author's page"""
+    response = fetcher.get(author_url)
+    html = decode_html(response.content, author_url, response.headers.get('Content-Type'))
+    return extract_book_links(html, author_url)
+
+
+def build_all(urls, journal=None, concurrency=DEFAULT_CONCURRENCY, fetcher=None, progress=None, profile=None):
+    """
+    Build all books of urls, concurrency at a time, skipping the ones the
+    journal already has as done. Returns {url: (status, result or error)}.
+    """
+    progress = progress or Progress()
+    root_dir = Path(__file__).parent.parent.resolve()
+    journal = journal if isinstance(journal, Journal) else Journal(journal or default_journal(root_dir, "\n".join(urls)))
+    own_fetcher = fetcher is None
+    if own_fetcher:
+        fetcher = Fetcher(cache=HttpCache(os.path.join(root_dir, "cache", "http")), stats=progress.stats)
+
+    todo = [url for url in urls if not journal.done(url)]
+    if len(todo) < len(urls):
+        progress.message(f"Resuming, {len(urls) - len(todo)} of {len(urls)} books are already done")
+    results = {}
+
+    def build(i, url):
+        book_progress = BookProgress(f"[{i}/{len(todo)}]", progress)
+        try:
+            result = from_url(url, book_progress, fetcher=fetcher, profile=profile)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            journal.record(url, 'failed', error=error)
+            results[url] = ('failed', error)
+            progress.error(f"[{i}/{len(todo)}] Failed: {url}: {error}", url=url)
+            return
+        # Incomplete books count as not done, a resumed run tries them again
+        status = 'incomplete' if book_progress.stats.get('sections_missing') else 'done'
+        journal.record(url, status, result=str(result))
+        results[url] = (status, str(result))
+        progress.message(f"[{i}/{len(todo)}] {status.capitalize()}: {result}")
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for i, url in enumerate(todo, 1):
+                pool.submit(build, i, url)
+    finally:
+        if own_fetcher:
+            fetcher.close()
+
+    failed = [url for url, (status, _) in results.items() if status != 'done']
+    progress.message(f"Built {len(results) - len(failed)} of {len(todo)} books"
+                     + (f", {len(failed)} failed or incomplete (run again to retry them)" if failed else ""))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("urls", nargs="*", help="book index URLs")
+    parser.add_argument("--file", help="file with one book URL per line")
+    parser.add_argument("--author", help="build every book linked from this page")
+    parser.add_argument("--journal", help="journal file (default: one per URL list in cache/batch/)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--profile", choices=PROFILES, help="zip compression, speed against size")
+    args = parser.parse_args()
+
+    progress = Progress()
+    root_dir = Path(__file__).parent.parent.resolve()
+    urls = list(args.urls)
+    if args.file:
+        with open(args.file, encoding='utf-8') as f:
+            urls += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+    with Fetcher(cache=HttpCache(os.path.join(root_dir, "cache", "http")), stats=progress.stats) as fetcher:
+        if args.author:
+            books = author_books(args.author, fetcher)
+            progress.message(f"Found {len(books)} books on {args.author}")
+            urls += books
+        if not urls:
+            parser.print_usage()
+            sys.exit(1)
+        # Keep the order, drop duplicates (also differently spelled ones)
+        unique = {}
+        for url in urls:
+            unique.setdefault(normalize_url(url), url)
+        urls = list(unique.values())
+        journal = args.journal or default_journal(root_dir, args.author or "\n".join(urls))
+        results = build_all(urls, journal, args.concurrency, fetcher, progress, args.profile)
+    if any(status != 'done' for status, _ in results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
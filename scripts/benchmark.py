@@ -0,0 +1,334 @@
+"""
+Offline benchmark of the whole pipeline against a local stand-in for marxists.org.
+
+The corpus lives in cache/benchmark/corpus: synthetic books that mimic the
+site (a small German pamphlet, a mid-size English book, a huge multi-chapter
+work and malformed early 2000s pages with uppercase tags), plus any book
+recorded from the real site with --record. It is served by a local HTTP
+server with a configurable latency per request.
+
+Every book is built in a fresh process on a throwaway copy of the repo (so
+no caches are shared and files/ stays untouched), once end to end through
+processer.from_url with the streaming pipeline and once stage by stage (or
+with the batch pipeline, see --modes). Reports wall time, CPU time, peak RSS, bytes
+written and the size of the EPUB.
+
+--sections adds books of growing size to the run, to see how peak memory
+scales: with the streaming pipeline it should stay flat no matter how many
+sections the book has, with the batch pipeline it grows with the book.
+
+    python benchmark.py [--books pamphlet,book] [--latency 0.05] [--save results.json]
+    python benchmark.py --baseline results.json      # exit 1 on regressions
+    python benchmark.py --books '' --sections 50,200,800 --modes e2e,batch --workers 1
+    python benchmark.py --record https://www.marxists.org/deutsch/.../index.htm name
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from functools import partial
+from pathlib import Path
+from urllib.parse import urlsplit
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+SCRIPT_DIR = Path(__file__).parent.resolve()
+ROOT_DIR = SCRIPT_DIR.parent
+CORPUS_DIR = ROOT_DIR / "cache" / "benchmark" / "corpus"
+# What a build needs of the repo
+REPO_PARTS = ["scripts", "templates", "Styles", "META-INF", "mimetype"]
+
+GERMAN = ("Die Geschichte aller bisherigen Gesellschaft ist die Geschichte von Klassenkämpfen. "
+          "Freier und Sklave, Patrizier und Plebejer, Baron und Leibeigener, Zunftbürger und "
+          "Gesell, kurz, Unterdrücker und Unterdrückte standen in stetem Gegensatz zueinander, "
+          "führten einen ununterbrochenen, bald versteckten, bald offenen Kampf. ")
+ENGLISH = ("The wealth of those societies in which the capitalist mode of production prevails, "
+           "presents itself as “an immense accumulation of commodities,” its unit being a single "
+           "commodity. Our investigation must therefore begin with the analysis of a commodity. ")
+
+# name: (language, encoding, chapters, sections per chapter, KB per section, legacy markup)
+BOOKS = {
+    'pamphlet': ('de', 'iso-8859-1', 1, 6, 8, False),
+    'book': ('en', 'utf-8', 6, 7, 30, False),
+    'huge': ('de', 'utf-8', 30, 14, 40, False),
+    'legacy': ('de', 'windows-1252', 3, 6, 15, True),
+}
+
+
+def page(title, body, encoding, legacy):
+    meta = '' if legacy else f'<meta http-equiv="Content-Type" content="text/html; charset={encoding}">'
+    html = f'<html><head>{meta}<title>{title}</title></head><body>\n{body}</body></html>'
+    if legacy:
+        # Uppercase tags, backslashes in links and closing tags, no charset anywhere
+        html = html.replace('<p', '<P').replace('</p>', '<\\P>').replace('<h', '<H').replace('</h', '</H')
+        html = html.replace('href="ch', 'href=".\\ch')
+    return html.encode(encoding, errors='xmlcharrefreplace')
+
+
+def write_book(name, spec, directory):
+    """Generate one synthetic book of the corpus"""
+    language, encoding, chapters, per_chapter, section_kb, legacy = spec
+    rng = random.Random(name)
+    text = GERMAN if language == 'de' else ENGLISH
+    directory.mkdir(parents=True, exist_ok=True)
+
+    toc = []
+    number = 0
+    for c in range(1, chapters + 1):
+        if chapters > 1:
+            toc.append(f'<h3>{"Teil" if language == "de" else "Part"} {c}</h3>')
+        for _ in range(per_chapter):
+            number += 1
+            title = f'{"Kapitel" if language == "de" else "Chapter"} {number}'
+            toc.append(f'<p><a href="ch{number:03d}.htm">{title}</a></p>')
+            paragraphs = []
+            size = 0
+            while size < section_kb * 1024:
+                sentence = text * rng.randint(1, 4)
+                paragraphs.append(f'<p>{sentence}<a href="#n{len(paragraphs)}" name="r{len(paragraphs)}">'
+                                  f'<sup>{len(paragraphs)}</sup></a></p>')
+                size += len(paragraphs[-1])
+            body = (f'<p class="next"><a href="index.htm">Inhalt</a></p>\n<h3>{title}</h3>\n'
+                    + "\n".join(paragraphs) + '\n<p class="updat">Zuletzt aktualisiert am 1. Mai 2004</p>\n')
+            (directory / f"ch{number:03d}.htm").write_bytes(page(title, body, encoding, legacy))
+
+    title = f"Benchmark {name.capitalize()}"
+    body = ('<h2>Karl Marx</h2>\n<h1>' + title + '</h1>\n<h3>(1867)</h3>\n<p class="info">Quelle: Benchmark</p>\n'
+            + "\n".join(toc) + '\n<p class="updat">Zuletzt aktualisiert</p>\n')
+    (directory / "index.htm").write_bytes(page(f"{title} (1867)", body, encoding, legacy))
+
+
+def scaled_books(sizes, section_kb):
+    """Names and specs of one-chapter books with the given numbers of sections"""
+    return {f"sections{n}x{section_kb}kb": ('de', 'utf-8', 1, n, section_kb, False) for n in sizes}
+
+
+def ensure_corpus(names):
+    for name in names:
+        if not (CORPUS_DIR / name / "index.htm").is_file():
+            if name not in BOOKS:
+                raise SystemExit(f"Unknown book {name}, record it first")
+            write_book(name, BOOKS[name], CORPUS_DIR / name)
+
+
+def record(url, name):
+    """Save a book from the real site (index and sections, as raw bytes) into the corpus"""
+    from fetcher import Fetcher
+    from manifest import extract_manifest
+    from charset import decode_html
+
+    directory = CORPUS_DIR / name
+    base = url.rsplit('/', 1)[0] + '/'
+    with Fetcher() as fetcher:
+        index = fetcher.get(url).content
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / "index.htm").write_bytes(index)
+        manifest = extract_manifest(decode_html(index, url), url)
+        links = [section.url for section in manifest.sections() if section.url.startswith(base)]
+        for link, response, error in fetcher.fetch_all(links):
+            if error:
+                print(f"Skipping {link}: {error}")
+                continue
+            target = directory / urlsplit(link).path[len(urlsplit(base).path):]
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.write_bytes(response.content)
+    print(f"Recorded {len(links)} sections of {url} into {directory}")
+
+
+class LatencyHandler(SimpleHTTPRequestHandler):
+    latency = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        super().do_GET()
+
+    def guess_type(self, path):
+        # Like most of marxists.org: no charset in the header
+        return "text/html" if str(path).endswith('.htm') else super().guess_type(path)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(latency):
+    handler = type("Handler", (LatencyHandler,), {'latency': latency})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(handler, directory=str(CORPUS_DIR)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bytes_written():
+    """Bytes this process passed to write() so far (Linux only)"""
+    try:
+        with open("/proc/self/io") as f:
+            return int(dict(line.split(": ") for line in f.read().splitlines())["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0
+
+
+def usage():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'wall': time.perf_counter(),
+        'cpu': self_usage.ru_utime + self_usage.ru_stime + children.ru_utime + children.ru_stime,
+        'peak_rss_mb': max(self_usage.ru_maxrss, children.ru_maxrss) / 1024,
+        'bytes_written': bytes_written(),
+    }
+
+
+def delta(before, after):
+    return {
+        'seconds': round(after['wall'] - before['wall'], 3),
+        'cpu_seconds': round(after['cpu'] - before['cpu'], 3),
+        'peak_rss_mb': round(after['peak_rss_mb'], 1),
+        'bytes_written': after['bytes_written'] - before['bytes_written'],
+    }
+
+
+# Modes building the book with processer.from_url, and its arguments. e2e
+# pins the streaming pipeline so EPUBBER_PIPELINE does not change what it measures
+PIPELINES = {'e2e': {'pipeline': 'stream'}, 'batch': {'pipeline': 'batch'}}
+
+
+def run_child(mode, url):
+    """Runs inside the throwaway repo copy, prints the measurements as JSON"""
+    from progress import Progress
+
+    class Quiet(Progress):
+        def publish(self, event):
+            pass
+
+    progress = Quiet()
+    results = {}
+    start = usage()
+    if mode in PIPELINES:
+        from processer import from_url
+        from_url(url, progress, **PIPELINES[mode])
+        results[mode] = delta(start, usage())
+    else:
+        from bookfiles import MemoryFiles
+        from fetcher import Fetcher
+        from downloader import download_book
+        from reformat import reformat
+        from epubber import create_epub
+        workspace = MemoryFiles()
+        with Fetcher() as fetcher:
+            manifest, _ = download_book(workspace, url, fetcher, progress)
+        after_download = usage()
+        results['download'] = delta(start, after_download)
+        reformat(SCRIPT_DIR, manifest, workspace, progress)
+        after_reformat = usage()
+        results['reformat'] = delta(after_download, after_reformat)
+        create_epub(workspace, static_dir=ROOT_DIR, progress=progress, manifest=manifest)
+        results['package'] = delta(after_reformat, usage())
+    print(json.dumps(results))
+
+
+def measure(mode, url, env):
+    """Build url in a fresh process on a fresh copy of the repo"""
+    with tempfile.TemporaryDirectory(prefix="epubber-bench-") as root:
+        for part in REPO_PARTS:
+            source = ROOT_DIR / part
+            if source.is_dir():
+                shutil.copytree(source, Path(root, part), ignore=shutil.ignore_patterns("__pycache__"))
+            elif source.exists():
+                shutil.copy(source, Path(root, part))
+        start = time.perf_counter()
+        child = subprocess.Popen([sys.executable, "benchmark.py", "--child", mode, url],
+                                 cwd=Path(root, "scripts"), env=env, stdout=subprocess.PIPE)
+        output = child.stdout.read()
+        _, status, child_usage = os.wait4(child.pid, 0)
+        elapsed = time.perf_counter() - start
+        if status != 0:
+            raise RuntimeError(f"{mode} build of {url} failed")
+        results = json.loads(output.decode().strip().splitlines()[-1])
+        if mode in PIPELINES:
+            # The whole process, interpreter start included
+            results[mode].update(seconds=round(elapsed, 3),
+                                 cpu_seconds=round(child_usage.ru_utime + child_usage.ru_stime, 3))
+        books = list(Path(root, "files").glob("*.epub")) if mode in PIPELINES else []
+        if books:
+            results[mode]['epub_bytes'] = books[0].stat().st_size
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of results against a saved baseline, beyond the relative tolerance"""
+    regressions = []
+    for book, stages in results.items():
+        for stage, values in stages.items():
+            old = baseline.get(book, {}).get(stage)
+            if not old:
+                continue
+            for metric in ('seconds', 'cpu_seconds', 'peak_rss_mb'):
+                if old.get(metric) and values[metric] > old[metric] * (1 + tolerance):
+                    regressions.append(f"{book}/{stage} {metric}: {old[metric]} -> {values[metric]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--books", default=",".join(BOOKS), help="comma separated books of the corpus")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the server waits per request")
+    parser.add_argument("--rate", type=float, default=1000, help="requests per second the fetcher may send")
+    parser.add_argument("--modes", default="e2e,stages", help="comma separated, of e2e (streaming), stages and batch")
+    parser.add_argument("--sections", help="comma separated numbers of sections, adds a book of each size")
+    parser.add_argument("--section-kb", type=int, default=40, help="size of one section of the --sections books")
+    parser.add_argument("--workers", type=int,
+                        help="reformat worker processes (1 keeps all work in the measured process)")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    parser.add_argument("--record", nargs=2, metavar=("URL", "NAME"), help="add a real book to the corpus")
+    args = parser.parse_args()
+
+    if args.record:
+        record(*args.record)
+        return
+
+    names = [name for name in args.books.split(",") if name]
+    if args.sections:
+        scaled = scaled_books([int(n) for n in args.sections.split(",")], args.section_kb)
+        BOOKS.update(scaled)
+        names += list(scaled)
+    ensure_corpus(names)
+    server = serve(args.latency)
+    env = dict(os.environ, EPUBBER_RATE=str(args.rate), EPUBBER_MAX_IN_FLIGHT="16")
+    if args.workers:
+        env['EPUBBER_REFORMAT_WORKERS'] = str(args.workers)
+    results = {}
+    try:
+        for name in names:
+            url = f"http://127.0.0.1:{server.server_port}/{name}/index.htm"
+            results[name] = {}
+            for mode in args.modes.split(","):
+                results[name].update(measure(mode, url, env))
+            for stage, values in results[name].items():
+                epub = f" {values['epub_bytes']:>10} bytes EPUB" if 'epub_bytes' in values else ""
+                print(f"{name:>16} {stage:>9}: {values['seconds']:>7.2f}s wall {values['cpu_seconds']:>7.2f}s cpu "
+                      f"{values['peak_rss_mb']:>7.1f} MB peak {values['bytes_written']:>10} bytes written{epub}")
+    finally:
+        server.shutdown()
+
+    if args.save:
+        Path(args.save).write_text(json.dumps(results, indent=2))
+    if args.baseline:
+        regressions = compare(results, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        run_child(*sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,88 @@
+import os
+from pathlib import Path
+
+# Downloaded pages live in Source/, the pages of the book in Text/
+SOURCE_INDEX = "Source/index.html"
+
+
+def source_name(i):
+    """Name of the downloaded page of section i (1-based)"""
+    return f"Source/Section{i:03d}.html"
+
+
+class MemoryFiles:
+    """
+    The files of a book being built (Source/*.html, Text/*.xhtml,
+    content.opf, ...), kept in memory. Names are archive paths like
+    "Text/Section001.xhtml".
+    """
+
+    def __init__(self):
+        self.files = {}
+
+    def write(self, name, data):
+        self.files[name] = data
+
+    def read(self, name):
+        data = self.files[name]
+        return data.decode('utf-8') if isinstance(data, bytes) else data
+
+    def read_bytes(self, name):
+        data = self.files[name]
+        return data.encode('utf-8') if isinstance(data, str) else data
+
+    def exists(self, name):
+        return name in self.files
+
+    def names(self):
+        """All file names, in the order they were first written"""
+        return list(self.files)
+
+    def clear(self, prefix=''):
+        for name in [name for name in self.files if name.startswith(prefix)]:
+            del self.files[name]
+
+
+class DirectoryFiles:
+    """Same interface as MemoryFiles, backed by a folder (what the command line tools use)"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def _path(self, name):
+        return self.root / name
+
+    def write(self, name, data):
+        path = self._path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(data, bytes):
+            path.write_bytes(data)
+        else:
+            path.write_text(data, encoding='utf-8')
+
+    def read(self, name):
+        return self._path(name).read_text(encoding='utf-8')
+
+    def read_bytes(self, name):
+        return self._path(name).read_bytes()
+
+    def exists(self, name):
+        return self._path(name).is_file()
+
+    def names(self):
+        """All file names, sorted"""
+        if not self.root.is_dir():
+            return []
+        return sorted(path.relative_to(self.root).as_posix() for path in self.root.rglob('*') if path.is_file())
+
+    def clear(self, prefix=''):
+        for name in self.names():
+            if name.startswith(prefix):
+                os.remove(self._path(name))
+
+
+def as_files(location):
+    """Accept a folder or a files object wherever the pipeline takes one"""
+    if isinstance(location, (str, os.PathLike)):
+        return DirectoryFiles(location)
+    return location
@@ -0,0 +1,93 @@
+import os
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit
+
+# Bump whenever reformatting/packaging changes the produced EPUBs,
+# so books built by an older pipeline get rebuilt.
+PIPELINE_VERSION = "9"
+
+# How long a finished book is trusted without looking at the sources again
+DEFAULT_TTL = 24 * 3600
+
+
+def normalize_url(url):
+    """Normalize a book URL so trivially different spellings share one cache entry"""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower() or 'https'
+    host = (parts.hostname or '').lower()
+    if parts.port and not ((scheme == 'http' and parts.port == 80) or (scheme == 'https' and parts.port == 443)):
+        host = f"{host}:{parts.port}"
+    if host.startswith('www.'):
+        host = host[4:]
+    path = parts.path or '/'
+    for index in ('index.htm', 'index.html'):
+        if path.endswith('/' + index):
+            path = path[:-len(index)]
+    # marxists.org serves the same pages over http and https
+    return urlunsplit(('https' if scheme == 'http' else scheme, host, path, parts.query, ''))
+
+
+class BuildCache:
+    """
+    Index of finished EPUBs.
+
+    Maps the normalized book URL to the hash of the sources it was built from,
+    the pipeline version and the resulting file (relative to `root_dir`).
+    """
+
+    def __init__(self, root_dir, ttl=DEFAULT_TTL):
+        self.root_dir = Path(root_dir)
+        self.ttl = ttl
+        cache_dir = self.root_dir / "cache"
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(cache_dir / "builds.sqlite", timeout=30, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS builds (
+            url TEXT PRIMARY KEY,
+            source_hash TEXT NOT NULL,
+            pipeline_version TEXT NOT NULL,
+            epub_path TEXT NOT NULL,
+            built_at REAL NOT NULL)""")
+        self.db.commit()
+
+    def _entry(self, url):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT source_hash, epub_path, built_at FROM builds WHERE url = ? AND pipeline_version = ?",
+                (normalize_url(url), PIPELINE_VERSION)).fetchone()
+        if row is None or not (self.root_dir / row[1]).is_file():
+            return None
+        return row
+
+    def lookup(self, url):
+        """Path of a finished book that is recent enough to be served as is, else None"""
+        row = self._entry(url)
+        if row and time.time() - row[2] < self.ttl:
+            return Path(row[1])
+        return None
+
+    def age(self, url):
+        """Seconds since the book was built (or its sources last checked), None if there is no build"""
+        row = self._entry(url)
+        return time.time() - row[2] if row else None
+
+    def lookup_sources(self, url, source_hash):
+        """Path of a finished book built from exactly these sources, else None"""
+        row = self._entry(url)
+        if row and row[0] == source_hash:
+            self.store(url, source_hash, row[1])
+            return Path(row[1])
+        return None
+
+    def store(self, url, source_hash, epub_path):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO builds VALUES (?, ?, ?, ?, ?)",
+                            (normalize_url(url), source_hash, PIPELINE_VERSION, os.fspath(epub_path), time.time()))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,137 @@
+import re
+import codecs
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+try:
+    from charset_normalizer import from_bytes
+
+    def guess_encoding(data):
+        match = from_bytes(data).best()
+        return match.encoding if match else None
+except ImportError:
+    try:
+        import chardet
+
+        def guess_encoding(data):
+            return chardet.detect(data)['encoding']
+    except ImportError:
+        def guess_encoding(data):
+            return None
+
+# Declarations have to be in the first 1024 bytes (HTML spec), old pages are sloppy
+SNIFF_BYTES = 4096
+# Heuristic detection only looks at this much of a page
+GUESS_BYTES = 64 * 1024
+# Directories whose encoding we remember
+MAX_DIRECTORIES = 4096
+
+BOMS = [
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+XML_DECLARATION = re.compile(rb'^\s*<\?xml[^>]*?encoding\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
+META_CHARSET = re.compile(rb'<meta[^>]+?charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE)
+HEADER_CHARSET = re.compile(r'charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE)
+# A tag with a backslash in it (<\p>, <br\>, <a href=".\ch01.htm">)
+BACKSLASH_TAG = re.compile(rb'<[^<>]*\\[^<>]*>')
+# The same on decoded text, for UTF-16 pages whose bytes can't be searched like that
+BACKSLASH_TAG_TEXT = re.compile(BACKSLASH_TAG.pattern.decode('ascii'))
+
+# Browsers treat these as windows-1252 and so do the pages that declare them
+# (curly quotes and dashes in the 0x80-0x9f range)
+ALIASES = {'iso8859-1': 'cp1252', 'latin-1': 'cp1252', 'ascii': 'cp1252'}
+
+_directories = OrderedDict()
+_directories_lock = threading.Lock()
+
+
+def normalize_encoding(name):
+    """Python codec name for a declared charset, None if there is no such codec"""
+    if not name:
+        return None
+    if isinstance(name, bytes):
+        name = name.decode('ascii', 'ignore')
+    try:
+        name = codecs.lookup(name.strip()).name
+    except LookupError:
+        return None
+    return ALIASES.get(name, name)
+
+
+def declared_encoding(data, content_type=None):
+    """Encoding declared by a BOM, the Content-Type header or the page itself (meta/XML declaration), else None"""
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return encoding
+    match = HEADER_CHARSET.search(content_type or '')
+    encoding = normalize_encoding(match.group(1)) if match else None
+    if encoding:
+        return encoding
+    head = data[:SNIFF_BYTES]
+    for pattern in (XML_DECLARATION, META_CHARSET):
+        match = pattern.search(head)
+        encoding = normalize_encoding(match.group(1)) if match else None
+        if encoding:
+            return encoding
+    return None
+
+
+def _directory(url):
+    parts = urlsplit(url or '')
+    return parts.netloc.lower(), parts.path.rsplit('/', 1)[0]
+
+
+def _remember(url, encoding):
+    key = _directory(url)
+    with _directories_lock:
+        _directories[key] = encoding
+        _directories.move_to_end(key)
+        while len(_directories) > MAX_DIRECTORIES:
+            _directories.popitem(last=False)
+
+
+def _recall(url):
+    with _directories_lock:
+        return _directories.get(_directory(url))
+
+
+def detect_encoding(data, url=None, content_type=None):
+    """
+    Encoding of a downloaded page, cheapest evidence first: BOM, header and
+    in-page declarations, then valid UTF-8, then whatever earlier pages of
+    the same directory turned out to be, and only then a heuristic guess.
+    """
+    encoding = declared_encoding(data, content_type)
+    if encoding:
+        _remember(url, encoding)
+        return encoding
+    try:
+        data.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    encoding = _recall(url) or normalize_encoding(guess_encoding(data[:GUESS_BYTES])) or 'cp1252'
+    _remember(url, encoding)
+    return encoding
+
+
+def decode_html(data, url=None, content_type=None):
+    """
+    Decode the raw bytes of a page.
+
+    Also repairs tags written with backslashes instead of slashes (<\\p>,
+    <br\\>) as some early 2000s pages have them. Tag case doesn't matter,
+    the parsers lowercase names anyway.
+    """
+    encoding = detect_encoding(data, url, content_type)
+    if encoding.startswith('utf-16'):
+        text = data.decode(encoding, errors='replace')
+        if '\\' in text:
+            text = BACKSLASH_TAG_TEXT.sub(lambda match: match.group().replace('\\', '/'), text)
+        return text
+    if b'\\' in data:
+        data = BACKSLASH_TAG.sub(lambda match: match.group().replace(b'\\', b'/'), data)
+    return data.decode(encoding, errors='replace')
@@ -1,95 +1,214 @@
 import os
-import re
 import sys
-import time
-import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin
+import hashlib
+from urllib.parse import urldefrag
+from fetcher import Fetcher
+from httpcache import HttpCache
+from progress import Progress
+from manifest import extract_manifest, BookManifest
+from charset import decode_html
+from bookfiles import as_files, DirectoryFiles, source_name, SOURCE_INDEX
+from sharedcache import default_cache
+
+# Levels of sub-index pages followed from a book's main page (volumes, parts of volumes)
+CRAWL_DEPTH = int(os.environ.get("EPUBBER_CRAWL_DEPTH", 2))
 
 def sanitize_filename(filename):
     """Sanitize filename to be filesystem-safe"""
     keep_chars = (' ', '.', '_', '-')
     return "".join(c if c.isalnum() or c in keep_chars else "" for c in filename)
 
-def download_book(root_dir, base_url):
-    try:
-        # Download the main page
-        print(f"Downloading main page: {base_url}")
-        response = requests.get(base_url)
-        response.raise_for_status()
-        html = response.text
-        # Handle malformed HTML from early 2000s
-        html = re.sub(r'<(/?[A-Z]+)>', lambda m: m.group(0).lower(), html)  # Lowercase tags
-        html = re.sub(r'<([^>]+)>', lambda m: m.group(0).replace('\\', '/'), html)  # Fix backslash
-
-        # Parse the main page
-        soup = BeautifulSoup(html, 'html.parser')
-
-        # Get page title for folder name
-        folder_name = os.path.join(root_dir, "Text")
-
-        # Create output directory
-        os.makedirs(folder_name, exist_ok=True)
-        with os.scandir(folder_name) as entries:
-            for entry in entries:
-                if entry.is_file():
-                    os.remove(entry.path)
-
-        # Save main page as index.html
-        with open(os.path.join(folder_name, "index.html"), 'w', encoding='utf-8') as f:
-            f.write(html)
-        print("Saved main page as index.html")
-
-        # Find all links between the markers
-        start_marker = soup.find('body')
-        end_marker = soup.find('p', {'class': 'updat'})
-
-        # Collect all unique links between these markers
-        links = []
-        current_element = start_marker.find_next() if start_marker else None
-        while current_element and current_element != end_marker:
-            if current_element.name == 'a' and current_element.get('href'):
-                href = current_element['href']
-                # Skip anchor links and non-HTML files
-                if not href.startswith('#') and not href.startswith('mailto:') and not href.startswith('http') and not href.startswith('..') and not href.endswith(('.pdf', '.jpg', '.png', 'index.htm', 'index.html')) and not 'translator.htm' in href and not "#" in href.split(".")[-1]:
-                    absolute_url = urljoin(base_url, href)
-                    if absolute_url != base_url:  # Don't include the main page again
-                        links.append(absolute_url)
-            current_element = current_element.find_next()
-
-        print(f"Found {len(links)} unique pages to download")
-
-        # Download each unique page with sequential numbering
-        for i, link in enumerate(links, 1):
+def page_text(response):
+    """Text of a downloaded page, see charset.decode_html"""
+    return decode_html(response.content, response.url, response.headers.get('Content-Type'))
+
+def index_manifest(html, url, cache, stats=None):
+    """The BookManifest of one index page, from the sharedcache.SharedCache if the page is unchanged"""
+    key = cache.key('manifest', url, html)
+    cached = cache.get(key, stats)
+    if cached is not None:
+        return BookManifest.from_json(cached)
+    manifest = extract_manifest(html, url)
+    cache.put(key, manifest.to_json())
+    return manifest
+
+def fetch_index(fetcher, base_url, progress=None, cache=None, depth=CRAWL_DEPTH):
+    """
+    Download the main page, returns its html and the BookManifest parsed
+    from it, with the sub-index pages it links to read in up to depth
+    levels deep (see crawl_subindexes)
+    """
+    progress = progress or Progress()
+    cache = cache or default_cache()
+    progress.stage('download', f"Downloading main page: {base_url}")
+    html = page_text(fetcher.get(base_url))
+
+    # Parse the main page, once, into the book manifest
+    manifest = index_manifest(html, base_url, cache, progress.stats)
+    crawl_subindexes(fetcher, manifest, progress, cache, depth)
+    return html, manifest
+
+def crawl_subindexes(fetcher, manifest, progress=None, cache=None, depth=CRAWL_DEPTH):
+    """
+    Read the sub-index pages of a multi-volume work into manifest.
+
+    The chapters extract_manifest made of sub-index links (the ones with a
+    url) get the sections of their page, the chapters of that page go right
+    after them, one level deeper. The pages of one level are fetched
+    concurrently, within the fetcher's budget, then the sub-index pages they
+    link to, up to depth levels. A section linked from several index pages
+    is only taken the first time it is found, sections a page brings in are
+    dropped if the book already has them. Sub-index pages that can't be
+    fetched or parsed (or are too deep) leave their chapter with the
+    sections it had.
+    """
+    progress = progress or Progress()
+    cache = cache or default_cache()
+    seen = {urldefrag(section.url)[0] for section in manifest.sections()}
+
+    def unseen(sections):
+        new = []
+        for section in sections:
+            if urldefrag(section.url)[0] not in seen:
+                seen.add(urldefrag(section.url)[0])
+                new.append(section)
+        return new
+    visited = {manifest.url} | {chapter.url for chapter in manifest.chapters if chapter.url}
+    unread = []
+    for level in range(1, depth + 1):
+        frontier = [chapter for chapter in manifest.chapters if chapter.url]
+        if not frontier:
+            break
+        progress.message(f"Found {len(frontier)} sub-index pages on level {level}")
+        for chapter, (url, response, error) in zip(frontier, fetcher.fetch_all(chapter.url for chapter in frontier)):
+            chapter.url = None
+            if error:
+                progress.error(f"Failed to download sub-index {url}: {str(error)}", stage='download', url=url)
+                unread.append(chapter)
+                continue
+            html = page_text(response)
             try:
-                print(f"Downloading {i}/{len(links)}: {link}")
-                time.sleep(1)  # Polite delay between requests
-                response = requests.get(link)
-                response.raise_for_status()
+                sub = index_manifest(html, url, cache, progress.stats)
+            except Exception as e:
+                # Not an index page after all (no author or title heading)
+                progress.error(f"Failed to read sub-index {url}: {str(e) or type(e).__name__}",
+                               stage='download', url=url)
+                unread.append(chapter)
+                continue
+            manifest.index_pages[url] = hashlib.sha256(html.encode('utf-8')).hexdigest()
+
+            # The first chapter of a page holds the sections before its first heading
+            chapter.sections = unseen(sub.chapters[0].sections) + chapter.sections
+            added = sub.chapters[1:]
+            for sub_chapter in added:
+                sub_chapter.level += chapter.level
+                sub_chapter.sections = unseen(sub_chapter.sections)
+                if sub_chapter.url in visited:
+                    sub_chapter.url = None
+                elif sub_chapter.url:
+                    visited.add(sub_chapter.url)
+            # By identity, an equal chapter may come earlier
+            position = next(i for i, other in enumerate(manifest.chapters) if other is chapter) + 1
+            manifest.chapters[position:position] = added
+
+    # Sub-index pages that are too deep or failed, without sections their chapter is dropped
+    unread += [chapter for chapter in manifest.chapters if chapter.url]
+    for chapter in unread:
+        chapter.url = None
+    manifest.chapters = [chapter for chapter in manifest.chapters
+                         if chapter.sections or not any(chapter is other for other in unread)]
+
+def index_hash(html, manifest):
+    """hashlib object over the main page and the sub-index pages of the book, sources are fed into it"""
+    source_hash = hashlib.sha256(html.encode('utf-8'))
+    for url, page_hash in sorted(manifest.index_pages.items()):
+        source_hash.update(f"\0index:{url}:{page_hash}".encode('utf-8'))
+    return source_hash
+
+def iter_sections(manifest, fetcher, source_hash, progress=None, window=None):
+    """
+    Download the sections of manifest, yields (i, html) in reading order as
+    they arrive (html is None for pages that failed), feeding them into
+    source_hash (a hashlib object). At most `window` pages are fetched ahead.
+
+    A rerun after a partly failed download only goes to the network for the
+    sections that failed, the others come from the fetcher's page cache.
+    """
+    progress = progress or Progress()
+    links = [section.url for section in manifest.sections()]
+    progress.message(f"Found {len(links)} unique pages to download")
+
+    # Download pages concurrently, the fetcher keeps us within the politeness budget
+    def on_done(i, link, error):
+        if error:
+            progress.error(f"Failed to download {link}: {str(error)}", stage='download', url=link)
+        else:
+            progress.item('download', i, len(links), url=link, text=f"Downloaded {i}/{len(links)}: {link}")
+
+    # Sequential numbering, in index order regardless of which fetch finished first
+    for i, (link, response, error) in enumerate(fetcher.iter_fetch(links, window, on_done), 1):
+        if error:
+            progress.stats.add('sections_missing')
+            source_hash.update(f"\0failed:{link}".encode('utf-8'))
+            yield i, None
+            continue
+        html = page_text(response)
+        source_hash.update(f"\0{link}\0".encode('utf-8'))
+        source_hash.update(html.encode('utf-8'))
+        yield i, html
+
+def download_sections(files, manifest, fetcher, source_hash, progress=None):
+    """
+    Download all sections of manifest into Source/SectionNNN.html of files,
+    feeding them into source_hash (a hashlib object)
+    """
+    for i, html in iter_sections(manifest, fetcher, source_hash, progress):
+        if html is not None:
+            # Formats as Section001.html, Section002.html, etc.
+            files.write(source_name(i), html)
+    return len(manifest.sections())
+
+def download_book(root_dir, base_url, fetcher=None, progress=None):
+    """
+    Download the index and all sections into Source/
+
+    root_dir is a folder or a bookfiles.MemoryFiles. Pages come through the
+    fetcher's page cache, so downloading a book again after an interrupted
+    or partly failed download only fetches the missing sections. Returns the
+    BookManifest of the index page and a hash over all sources.
+    """
+    progress = progress or Progress()
+    files = as_files(root_dir)
+    own_fetcher = fetcher is None
+    if own_fetcher:
+        cache = HttpCache(os.path.join(root_dir, "cache", "http")) if isinstance(files, DirectoryFiles) else None
+        fetcher = Fetcher(cache=cache)
+    try:
+        html, manifest = fetch_index(fetcher, base_url, progress)
+        count = len(manifest.sections())
 
-                # Save with sequential numbering
-                filename = f"Section{i:03d}.xhtml"  # Formats as Section001.xhtml, Section002.xhtml, etc.
-                filepath = os.path.join(folder_name, filename)
+        # Start from an empty Source/ folder
+        files.clear("Source/")
 
-                html = response.text
-                html = re.sub(r'<(/?[A-Z]+)>', lambda m: m.group(0).lower(), html)  # Lowercase tags
-                html = re.sub(r'<([^>]+)>', lambda m: m.group(0).replace('\\', '/'), html)  # Fix backslash
+        source_hash = index_hash(html, manifest)
 
-                # Save the content
-                with open(filepath, 'w', encoding='utf-8') as f:
-                    f.write(html)
+        # Save main page as index.html
+        files.write(SOURCE_INDEX, html)
+        progress.message("Saved main page as index.html")
 
-            except Exception as e:
-                print(f"Failed to download {link}: {str(e)}")
-                continue
+        download_sections(files, manifest, fetcher, source_hash, progress)
 
-        print(f"\nDownload complete! Files saved in: {folder_name}")
-        print(f"- index.html (main page)")
-        print(f"- {len(links)} section files (Section001.xhtml to Section{len(links):03d}.xhtml)")
+        progress.message(f"\nDownload complete! Files saved in: {getattr(files, 'root', 'memory')}")
+        progress.message(f"- index.html (main page)")
+        progress.message(f"- {count} section files (Section001.html to Section{count:03d}.html)")
+        return manifest, source_hash.hexdigest()
 
     except Exception as e:
-        print(f"Error: {str(e)}")
-        sys.exit(1)
+        progress.error(f"Error: {str(e)}", stage='download')
+        raise
+    finally:
+        if own_fetcher:
+            fetcher.close()
 
 
 if __name__ == "__main__":
@@ -99,4 +218,7 @@ if __name__ == "__main__":
 
     base_url = sys.argv[1]
     root_dir = os.path.join(__file__, "..")
-    download_book(root_dir, base_url)
+    try:
+        download_book(root_dir, base_url)
+    except Exception:
+        sys.exit(1)
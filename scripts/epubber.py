@@ -1,65 +1,20 @@
 import os
-import zipfile
+from functools import lru_cache
 from pathlib import Path
 import xml.etree.ElementTree as ET
 import re
 import time
-
-def limit_folder_size(output_dir: Path, max_size_gb: float = 1.0, min_size_gb: float = 0.9):
-    """
-    Deletes oldest files in `output_dir` if folder size > `max_size_gb` GB
-    until size < `min_size_gb` GB.
-    """
-    print("Checking if library has enough space left...")
-    max_size_bytes = max_size_gb * 1024**3  # Convert GB to bytes
-    min_size_bytes = min_size_gb * 1024**3
-
-    # Get folder size recursively
-    def get_folder_size(folder: Path) -> int:
-        return sum(f.stat().st_size for f in folder.glob('**/*') if f.is_file())
-
-    current_size = get_folder_size(output_dir)
-
-    if current_size <= max_size_bytes:
-        print(f"Library has enough room left.")
-        return
-
-    print(f"Folder size ({current_size/1024**3:.2f} GB) exceeds {max_size_gb} GB. Cleaning...")
-
-    # Get all files with their last modification time
-    files = []
-    for f in output_dir.glob('*'):
-        if f.is_file():
-            files.append((f.stat().st_mtime, f))
-
-    # Sort files by oldest first
-    files.sort(key=lambda x: x[0])
-
-    # Delete oldest files until under threshold
-    deleted_count = 0
-    for mtime, file in files:
-        if current_size <= min_size_bytes:
-            break
-
-        file_size = file.stat().st_size
-        try:
-            file.unlink()  # Delete the file
-            current_size -= file_size
-            deleted_count += 1
-            print(f"Deleted: {file.name} ({file_size/1024**2:.2f} MB)")
-        except Exception as e:
-            print(f"Error deleting {file.name}: {e}")
-
-    print(f"Deleted {deleted_count} files. New size: {current_size/1024**3:.2f} GB")
-
-# Usage example:
-output_dir = Path("/path/to/your/folder")
-limit_folder_size(output_dir)
-def get_metadata_from_opf(opf_path):
-    """Extract title and author from content.opf"""
+import hashlib
+import threading
+from progress import Progress
+from bookfiles import as_files
+from buildcache import normalize_url
+from zipwriter import ZipWriter, compress, compress_all, compression_level, STORED, DEFLATED
+
+def get_metadata_from_opf(opf_path, opf_text=None):
+    """Extract title and author from content.opf (a file, or its text)"""
     try:
-        tree = ET.parse(opf_path)
-        root = tree.getroot()
+        root = ET.fromstring(opf_text) if opf_text is not None else ET.parse(opf_path).getroot()
 
         # Namespace handling
         ns = {'opf': 'http://www.idpf.org/2007/opf',
@@ -76,78 +31,155 @@ def get_metadata_from_opf(opf_path):
     except Exception as e:
         raise ValueError(f"Could not parse metadata from {opf_path}: {str(e)}")
 
-def create_epub(content_dir='.'):
-    print("Creating epub from reformatted files...")
-    """Package an EPUB with automatic naming"""
-    # Required EPUB paths
-    paths = {
-        'mimetype': os.path.join(content_dir, 'mimetype'),
-        'container': os.path.join(content_dir, 'META-INF', 'container.xml'),
-        'content_opf': os.path.join(content_dir, 'content.opf'),
-        'text_dir': os.path.join(content_dir, 'Text'),
-        'styles_dir': os.path.join(content_dir, 'Styles')
-    }
+CONTAINER_XML = '''<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>'''
+
+DEFAULTS = {'mimetype': 'application/epub+zip', 'META-INF/container.xml': CONTAINER_XML}
+
+def epub_filename(manifest):
+    """
+    File name of the book described by manifest. Editions or volumes with the
+    same title and author live at different URLs, the hash of the URL keeps
+    them from overwriting each other's file.
+    """
+    title = re.sub(r'[\\/*?:"<>|]', '_', manifest.title.strip())
+    author = re.sub(r'[\\/*?:"<>|]', '_', manifest.author.strip())
+    url_hash = hashlib.sha256(normalize_url(manifest.url).encode('utf-8')).hexdigest()[:8]
+    return f"{title} - {author} - {url_hash}.epub"
+
+def static_files(static_dir):
+    """(name, path) of the shared files that go into every EPUB, in zip order, None where a default is used"""
+    mimetype = os.path.join(static_dir, 'mimetype')
+    container = os.path.join(static_dir, 'META-INF', 'container.xml')
+    files = [('mimetype', mimetype if os.path.exists(mimetype) else None),
+             ('META-INF/container.xml', container if os.path.exists(container) else None)]
+    styles_dir = os.path.join(static_dir, 'Styles')
+    if os.path.exists(styles_dir):
+        for root, _, style_files in os.walk(styles_dir):
+            for file in style_files:
+                if file.endswith('.css'):
+                    full_path = os.path.join(root, file)
+                    files.append((os.path.relpath(full_path, static_dir).replace(os.sep, '/'), full_path))
+    return files
+
+@lru_cache(maxsize=16)
+def _compress_static(files, level):
+    entries = []
+    for name, path, _ in files:
+        data = Path(path).read_bytes() if path else DEFAULTS[name]
+        # mimetype must be the first entry and uncompressed
+        entries.append(compress(name, data, level, STORED if name == 'mimetype' else DEFLATED))
+    return entries[:2], entries[2:]
+
+def static_entries(static_dir, level):
+    """
+    (head, styles): ready zip entries of the shared files, mimetype and
+    container.xml to open the book with, the stylesheets to close it.
+    They are the same for every book, so they are compressed once per
+    process and level, and again only when one of the files changes.
+    """
+    files = tuple((name, path, os.stat(path).st_mtime_ns if path else None) for name, path in static_files(static_dir))
+    return _compress_static(files, level)
 
+def create_epub(content_dir='.', static_dir=None, output_dir=None, progress=None, manifest=None, profile=None):
+    """
+    Package an EPUB with automatic naming
+
+    content_dir holds the per-build files (content.opf, Text/), either a
+    folder or a bookfiles.MemoryFiles, which are then written straight into
+    the zip. static_dir holds the shared read-only ones (mimetype, META-INF/,
+    Styles/) and defaults to the content_dir folder. The book is written to output_dir (default: static_dir/files)
+    and its path is returned relative to static_dir. With the book's manifest
+    the file name comes from it instead of from content.opf. profile is one
+    of zipwriter.PROFILES (default: EPUBBER_ZIP_PROFILE).
+    """
+    progress = progress or Progress()
+    progress.stage('package', "Creating epub from reformatted files...")
+    files = as_files(content_dir)
+    static_dir = static_dir or content_dir
     # Validate required files
-    if not os.path.exists(paths['content_opf']):
-        raise FileNotFoundError(f"Missing content.opf at {paths['content_opf']}")
+    if not files.exists('content.opf'):
+        raise FileNotFoundError(f"Missing content.opf in {getattr(files, 'root', 'memory')}")
 
     # Get metadata for filename
-    title, author = get_metadata_from_opf(paths['content_opf'])
+    if manifest:
+        filename = epub_filename(manifest)
+    else:
+        title, author = get_metadata_from_opf('content.opf', files.read('content.opf'))
+        filename = f"{title} - {author}.epub"
 
     # Create output directory structure
-    output_dir = Path(os.path.join(content_dir, "files"))
+    output_dir = Path(output_dir or os.path.join(static_dir, "files"))
     output_dir.mkdir(exist_ok=True)
-    epub_path = output_dir / f"{title} - {author}.epub"
-
-    limit_folder_size(output_dir, 1.0, 0.9)
-
-    # Create EPUB (ZIP with specific structure)
-    with zipfile.ZipFile(epub_path, 'w', zipfile.ZIP_DEFLATED) as epub:
-        # 1. Add mimetype first (uncompressed)
-        mimetype_path = paths['mimetype']
-        if not os.path.exists(mimetype_path):
-            with open(mimetype_path, 'w') as f:
-                f.write('application/epub+zip')
-        epub.write(mimetype_path, 'mimetype', compress_type=zipfile.ZIP_STORED)
-
-        # 2. Add container.xml
-        container_dir = os.path.dirname(paths['container'])
-        os.makedirs(container_dir, exist_ok=True)
-        if not os.path.exists(paths['container']):
-            with open(paths['container'], 'w') as f:
-                f.write('''<?xml version="1.0"?>
-<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
-  <rootfiles>
-    <rootfile full-path="content.opf" media-type="application/oebps-package+xml"/>
-  </rootfiles>
-</container>''')
-        epub.write(paths['container'], 'META-INF/container.xml')
-
-        # 3. Add content.opf
-        epub.write(paths['content_opf'], 'content.opf')
-
-        # 4. Add all HTML files in Text/
-        if os.path.exists(paths['text_dir']):
-            for root, _, files in os.walk(paths['text_dir']):
-                for file in files:
-                    if file.endswith(('.xhtml', '.html')) and not file.startswith('index'):
-                        full_path = os.path.join(root, file)
-                        arc_path = os.path.relpath(full_path, content_dir)
-                        epub.write(full_path, arc_path)
-
-        # 5. Add all CSS files in Styles/
-        if os.path.exists(paths['styles_dir']):
-            for root, _, files in os.walk(paths['styles_dir']):
-                for file in files:
-                    if file.endswith('.css'):
-                        full_path = os.path.join(root, file)
-                        arc_path = os.path.relpath(full_path, content_dir)
-                        epub.write(full_path, arc_path)
-
-    rel_epub_path = Path(epub_path).relative_to(content_dir)
-    print(f"Successfully created EPUB: {rel_epub_path}")
+    epub_path = output_dir / filename
+
+    # Build under a temporary name, so concurrent builds of the same book
+    # never see (or serve) a half written file
+    tmp_path = output_dir / f".{epub_path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    # Create EPUB (ZIP with specific structure): 1. mimetype first (uncompressed),
+    # 2. container.xml, 3. content.opf, 4. all HTML files in Text/, 5. the images, 6. all CSS files in Styles/
+    start = time.perf_counter()
+    level = compression_level(profile)
+    head, styles = static_entries(static_dir, level)
+    names = ['content.opf'] + [name for name in files.names()
+                               if name.startswith('Text/') and name.endswith(('.xhtml', '.html'))
+                               and not os.path.basename(name).startswith('index')]
+    names += [name for name in files.names() if name.startswith('Images/')]
+    writer = ZipWriter()
+    with open(tmp_path, 'wb') as epub:
+        for entry in head:
+            epub.write(writer.add(entry))
+        # The pages are deflated side by side in the zip thread pool, and written in order
+        for entry in compress_all(((name, files.read_bytes(name)) for name in names), level):
+            epub.write(writer.add(entry))
+        for entry in styles:
+            epub.write(writer.add(entry))
+        epub.write(writer.finish())
+
+    progress.stats.package(time.perf_counter() - start, tmp_path.stat().st_size)
+    os.replace(tmp_path, epub_path)
+
+    rel_epub_path = Path(os.path.relpath(epub_path, static_dir))
+    progress.message(f"Successfully created EPUB: {rel_epub_path}")
     return rel_epub_path
 
+def stream_epub(pages, static_dir, progress=None, profile=None):
+    """
+    Package an EPUB on the fly, yields it in chunks
+
+    pages are the (name, text or data) of the book (content.opf, Text/ pages
+    and Images/, as reformat.iter_book_pages yields them). Pages are
+    compressed a few at a time in the zip thread pool and each is sent as
+    soon as it is done, only a small window of them is ever held in memory.
+    """
+    progress = progress or Progress()
+    progress.stage('package', "Streaming epub...")
+    level = compression_level(profile)
+    writer = ZipWriter()
+    head, styles = static_entries(static_dir, level)
+    size = 0
+    for entry in head:
+        chunk = writer.add(entry)
+        size += len(chunk)
+        yield chunk
+
+    # Waiting for pages is the reformat's time, only the compression counts here
+    zip_seconds = 0.0
+    for entry in compress_all(pages, level):
+        chunk = writer.add(entry)
+        zip_seconds += entry.seconds
+        size += len(chunk)
+        yield chunk
+
+    chunk = b"".join(writer.add(entry) for entry in styles) + writer.finish()
+    progress.stats.package(zip_seconds, size + len(chunk))
+    yield chunk
+
+
 if __name__ == '__main__':
     create_epub()
@@ -0,0 +1,294 @@
+import os
+import time
+import math
+import random
+import threading
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from metrics import BuildStats
+
+# Politeness budget towards a single host, for the whole process (and all
+# processes sharing a Redis, see share_budgets), the same one request per
+# second the sequential downloader kept to. The environment overrides are
+# meant for local test servers.
+DEFAULT_RATE = float(os.environ.get("EPUBBER_RATE", 1.0))                  # requests per second
+DEFAULT_MAX_IN_FLIGHT = int(os.environ.get("EPUBBER_MAX_IN_FLIGHT", 3))    # concurrent requests
+DEFAULT_WORKERS = 6
+# Longest Retry-After we honor, a server asking for more gets this
+MAX_RETRY_AFTER = 60.0
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+USER_AGENT = "marxists.org-epubber (+https://github.com/KevinFlummi/marxists.org_epubber)"
+
+
+class HostBudget:
+    """Limits requests to one host: a minimum spacing between request starts
+    (requests per second) and a cap on requests in flight.
+
+    With a redis client, request starts are also spaced across all processes
+    using it: every interval is a slot that only one request may take."""
+
+    def __init__(self, rate=DEFAULT_RATE, max_in_flight=DEFAULT_MAX_IN_FLIGHT, redis_client=None, key=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        self.next_start = 0.0
+        self.redis = redis_client
+        self.key = key
+
+    def __enter__(self):
+        self.slots.acquire()
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+        if self.redis is not None and self.interval:
+            self._take_shared_slot()
+        return self
+
+    def _take_shared_slot(self):
+        while True:
+            now = time.time()
+            slot = int(now / self.interval)
+            try:
+                with self.redis.pipeline(transaction=False) as pipe:
+                    pipe.incr(f"{self.key}:{slot}")
+                    pipe.expire(f"{self.key}:{slot}", math.ceil(self.interval) + 1)
+                    taken = pipe.execute()[0]
+            except Exception:
+                # Without Redis the budget of this process still holds
+                return
+            if taken == 1:
+                return
+            time.sleep((slot + 1) * self.interval - now)
+
+    def __exit__(self, *exc):
+        self.slots.release()
+
+    def hold_off(self, seconds):
+        """Push back the next request start, e.g. after a Retry-After"""
+        with self.lock:
+            self.next_start = max(self.next_start, time.monotonic() + seconds)
+
+
+def retry_after_seconds(response):
+    """Parse a Retry-After header (seconds or HTTP date, at most MAX_RETRY_AFTER), None if missing/invalid"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return min(float(value), MAX_RETRY_AFTER)
+    try:
+        return min(max(0.0, parsedate_to_datetime(value).timestamp() - time.time()), MAX_RETRY_AFTER)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+_budgets = {}
+_budgets_lock = threading.Lock()
+_budgets_redis = None
+
+
+def share_budgets(redis_client, prefix="epubber"):
+    """Space the requests of all processes using this Redis, not just of this one (call before fetching)"""
+    global _budgets_redis
+    with _budgets_lock:
+        _budgets_redis = (redis_client, prefix)
+        _budgets.clear()
+
+
+def host_budget(host):
+    """The HostBudget of host, shared by all Fetchers (and so all builds) of the process"""
+    with _budgets_lock:
+        if host not in _budgets:
+            redis_client, prefix = _budgets_redis or (None, None)
+            _budgets[host] = HostBudget(redis_client=redis_client, key=f"{prefix}:budget:{host}")
+        return _budgets[host]
+
+
+def cached_response(entry):
+    """Build a requests.Response from an HttpCache entry"""
+    response = requests.Response()
+    response.status_code = 200
+    response.url = entry['url']
+    response._content = entry['body']
+    response.headers = CaseInsensitiveDict()
+    if entry.get('content_type'):
+        response.headers['Content-Type'] = entry['content_type']
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.from_cache = True
+    return response
+
+
+class Fetcher:
+    """
+    Fetches pages over one shared keep-alive session with a bounded worker pool.
+
+    Requests to a host go through its HostBudget, which all Fetchers of the
+    process share, so neither more workers nor more concurrent builds make
+    us hit marxists.org harder than DEFAULT_RATE requests per second. A
+    Fetcher given its own `rate` or `max_in_flight` keeps to those on top
+    (to be gentler, not to get around the shared budget). With an
+    HttpCache, fresh pages never touch the network and stale ones are
+    revalidated with a conditional request. Request latencies, bytes,
+    retries and cache hits are recorded in `stats` (a metrics.BuildStats).
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, rate=None, max_in_flight=None,
+                 retries=3, backoff=1.0, timeout=30, cache=None, stats=None):
+        self.workers = workers
+        self.rate = rate
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+        self.stats = stats or BuildStats()
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(workers, max_in_flight or DEFAULT_MAX_IN_FLIGHT))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._budgets = {}
+        self._budgets_lock = threading.Lock()
+
+    def budgets(self, url):
+        """The budgets a request to url has to get through, this Fetcher's own (if any) first"""
+        host = urlsplit(url).netloc.lower()
+        if self.rate is None and self.max_in_flight is None:
+            return [host_budget(host)]
+        with self._budgets_lock:
+            if host not in self._budgets:
+                self._budgets[host] = HostBudget(self.rate or DEFAULT_RATE,
+                                                 self.max_in_flight or DEFAULT_MAX_IN_FLIGHT)
+            return [self._budgets[host], host_budget(host)]
+
+    def get(self, url):
+        """GET through the cache (if any)"""
+        entry = self.cache.get(url) if self.cache else None
+        if entry and entry['fresh']:
+            self.stats.cache('fresh')
+            self.stats.page(len(entry['body']), from_cache=True)
+            return cached_response(entry)
+
+        headers = self.cache.conditional_headers(entry) if entry else {}
+        response = self.request(url, headers)
+        if response.status_code == 304 and entry:
+            self.cache.touch(url)
+            self.stats.cache('revalidated')
+            self.stats.page(len(entry['body']), from_cache=True)
+            return cached_response(entry)
+
+        self.stats.page(len(response.content))
+        if self.cache:
+            self.stats.cache('miss')
+            self.cache.put(url, response.content,
+                           etag=response.headers.get('ETag'),
+                           last_modified=response.headers.get('Last-Modified'),
+                           content_type=response.headers.get('Content-Type'))
+        response.from_cache = False
+        return response
+
+    def request(self, url, headers=None):
+        """GET with retries and exponential backoff, honoring Retry-After"""
+        budgets = self.budgets(url)
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * 2 ** attempt * (1 + random.random() / 2)
+            try:
+                with ExitStack() as stack:
+                    for budget in budgets:
+                        stack.enter_context(budget)
+                    start = time.perf_counter()
+                    try:
+                        response = self.session.get(url, headers=headers, timeout=self.timeout)
+                    finally:
+                        self.stats.request(time.perf_counter() - start)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUS or attempt == self.retries:
+                    response.raise_for_status()
+                    return response
+                wait = retry_after_seconds(response)
+                if wait is not None:
+                    delay = wait
+                    for budget in budgets:
+                        budget.hold_off(wait)
+            self.stats.retry()
+            time.sleep(delay)
+
+    def fetch_all(self, urls, on_done=None):
+        """
+        Fetch all urls concurrently.
+
+        Returns a list of (url, response, error) tuples in the same order as
+        `urls`, no matter which request finishes first. `on_done(i, url, error)`
+        is called as soon as each fetch completes (i is 1-based).
+        """
+        urls = list(urls)
+        results = [None] * len(urls)
+
+        def task(i, url):
+            try:
+                results[i] = (url, self.get(url), None)
+            except Exception as e:
+                self.stats.fetch_failed()
+                results[i] = (url, None, e)
+            if on_done:
+                on_done(i + 1, url, results[i][2])
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for i, url in enumerate(urls):
+                pool.submit(task, i, url)
+        return results
+
+    def iter_fetch(self, urls, window=None, on_done=None):
+        """
+        Like fetch_all, but yields the (url, response, error) tuples one by one
+        in order, with at most `window` fetches (default: twice the workers)
+        running or waiting ahead of the consumer.
+        """
+        window = window or 2 * self.workers
+
+        def task(i, url):
+            try:
+                result = (url, self.get(url), None)
+            except Exception as e:
+                self.stats.fetch_failed()
+                result = (url, None, e)
+            if on_done:
+                on_done(i + 1, url, result[2])
+            return result
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque()
+            for i, url in enumerate(urls):
+                pending.append(pool.submit(task, i, url))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def close(self):
+        self.session.close()
+        if self.cache:
+            self.cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,100 @@
+import re
+from functools import lru_cache
+
+try:
+    # rapidfuzz is a lot faster and scores all headings in one call
+    from rapidfuzz import fuzz, process, utils
+
+    def ratio(text1, text2):
+        return fuzz.token_set_ratio(text1, text2, processor=utils.default_process)
+
+    def close_matches(query, choices, threshold):
+        """Indices of all choices scoring at least threshold, in one batched call"""
+        matches = process.extract(query, choices, scorer=fuzz.token_set_ratio, processor=utils.default_process,
+                                  limit=None, score_cutoff=threshold)
+        return {index for _, _, index in matches}
+except ImportError:
+    from fuzzywuzzy import fuzz
+
+    def ratio(text1, text2):
+        return fuzz.token_set_ratio(text1, text2)
+
+    def close_matches(query, choices, threshold):
+        """Indices of all choices scoring at least threshold"""
+        return {i for i, choice in enumerate(choices) if fuzz.token_set_ratio(query, choice) >= threshold}
+
+HEADING_TAGS = ['h1', 'h2', 'h3', 'h4']
+
+# Normalize common German variations
+GERMAN_VARIATIONS = [
+    (re.compile(r'\bder\b'), '(der|des|dem|den)'),  # Articles
+    (re.compile(r'\bdas\b'), '(das|dem|des)'),
+    (re.compile(r'\bdie\b'), '(die|der|den)'),
+    (re.compile(r'\bein\b'), '(ein|einen|eines|einem|einer)'),
+    (re.compile(r'(\w+)s\b'), r'\1(s|es)?'),  # Genitive/plural forms
+]
+
+
+@lru_cache(maxsize=4096)
+def german_pattern(text):
+    """Compiled flexible pattern for text, None if the text doesn't make a valid regex"""
+    pattern = text.lower()
+    for rgx, replacement in GERMAN_VARIATIONS:
+        pattern = rgx.sub(replacement, pattern)
+    try:
+        return re.compile(pattern)
+    except re.error:
+        return None
+
+
+def german_fuzzy_match(text1, text2, threshold=85):
+    """Special handling for German grammatical variations"""
+    # Check direct match with normalized patterns
+    pattern1 = german_pattern(text1)
+    pattern2 = german_pattern(text2)
+    if (pattern1 and pattern1.fullmatch(text2.lower())) or (pattern2 and pattern2.fullmatch(text1.lower())):
+        return True
+
+    # Fallback to fuzzy matching
+    return ratio(text1, text2) >= threshold
+
+
+def words_match(words1, words2):
+    """At least 80% of the words of either side appear in the other"""
+    common_words = words1 & words2
+    return len(common_words) >= max(1, 0.8*len(words1)) or len(common_words) >= max(1, 0.8*len(words2))
+
+
+class HeadingIndex:
+    """
+    The h1-h4 headings of one page, normalized and tokenized once,
+    to find the heading a TOC entry refers to.
+    """
+
+    def __init__(self, soup):
+        self.headings = soup.find_all(HEADING_TAGS)
+        self.texts = [heading.get_text(' ', strip=True).lower() for heading in self.headings]
+        self.words = [set(text.split()) for text in self.texts]
+
+    def match(self, section, threshold=85):
+        """
+        First heading that matches the section title, falls back to the last
+        heading of the page, None if the page has no headings at all.
+        """
+        if not self.headings:
+            return None
+        close = close_matches(section, self.texts, threshold)
+        section_lower = section.lower()
+        section_pattern = german_pattern(section)
+        section_words = set(section_lower.split())
+        for i, text in enumerate(self.texts):
+            if i in close:
+                return self.headings[i]
+            if section_pattern and section_pattern.fullmatch(text):
+                return self.headings[i]
+            heading_pattern = german_pattern(text)
+            if heading_pattern and heading_pattern.fullmatch(section_lower):
+                return self.headings[i]
+            if words_match(section_words, self.words[i]):
+                return self.headings[i]
+        return self.headings[-1]
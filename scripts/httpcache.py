@@ -0,0 +1,128 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+
+DEFAULT_MAX_SIZE_MB = 500
+DEFAULT_TTL = 7 * 24 * 3600  # most marxists.org pages haven't changed in decades
+
+
+class HttpCache:
+    """
+    Persistent on-disk cache of raw HTTP responses, keyed by URL.
+
+    Bodies live as files in `cache_dir`, the metadata (ETag, Last-Modified,
+    Content-Type, size, fetch and access times) in a small SQLite index.
+    Entries younger than `ttl` are served without touching the network, older
+    ones are revalidated with If-None-Match / If-Modified-Since. The total size
+    is capped at `max_size_mb`, least recently used entries are evicted first.
+    """
+
+    def __init__(self, cache_dir, max_size_mb=DEFAULT_MAX_SIZE_MB, ttl=DEFAULT_TTL):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size_mb * 1024**2
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.cache_dir / "index.sqlite", timeout=30, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS entries (
+            url TEXT PRIMARY KEY,
+            key TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            content_type TEXT,
+            size INTEGER NOT NULL,
+            fetched_at REAL NOT NULL,
+            accessed_at REAL NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+        self.db.commit()
+        self.total_size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def _body_path(self, key):
+        return self.cache_dir / f"{key}.body"
+
+    def get(self, url):
+        """Returns a dict with the cached entry (incl. 'body' and 'fresh'), or None"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT key, etag, last_modified, content_type, size, fetched_at FROM entries WHERE url = ?",
+                (url,)).fetchone()
+            if row is None:
+                return None
+            key, etag, last_modified, content_type, size, fetched_at = row
+            try:
+                body = self._body_path(key).read_bytes()
+            except OSError:
+                # Body got lost, forget about the entry
+                self._delete(url, key, size)
+                self.db.commit()
+                return None
+            self.db.execute("UPDATE entries SET accessed_at = ? WHERE url = ?", (time.time(), url))
+            self.db.commit()
+        return {
+            'url': url,
+            'body': body,
+            'etag': etag,
+            'last_modified': last_modified,
+            'content_type': content_type,
+            'fresh': time.time() - fetched_at < self.ttl,
+        }
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def touch(self, url):
+        """Mark an entry as revalidated (304 Not Modified)"""
+        with self.lock:
+            now = time.time()
+            self.db.execute("UPDATE entries SET fetched_at = ?, accessed_at = ? WHERE url = ?", (now, now, url))
+            self.db.commit()
+
+    def put(self, url, body, etag=None, last_modified=None, content_type=None):
+        key = self.key(url)
+        path = self._body_path(key)
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(body)
+        with self.lock:
+            old = self.db.execute("SELECT size FROM entries WHERE url = ?", (url,)).fetchone()
+            os.replace(tmp, path)
+            now = time.time()
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, key, etag, last_modified, content_type, len(body), now, now))
+            self.total_size += len(body) - (old[0] if old else 0)
+            self._evict()
+            self.db.commit()
+
+    def _delete(self, url, key, size):
+        self.db.execute("DELETE FROM entries WHERE url = ?", (url,))
+        try:
+            self._body_path(key).unlink()
+        except FileNotFoundError:
+            pass
+        self.total_size -= size
+
+    def _evict(self):
+        """Drop least recently used entries until we are below the size cap"""
+        if self.total_size <= self.max_size:
+            return
+        rows = self.db.execute("SELECT url, key, size FROM entries ORDER BY accessed_at").fetchall()
+        for url, key, size in rows:
+            if self.total_size <= self.max_size:
+                break
+            self._delete(url, key, size)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,189 @@
+import io
+import os
+import re
+import hashlib
+import threading
+from html import unescape
+from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor
+from progress import Progress
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# E-ink profile: fits the screen of a 6-8" reader, grayscale, 16 levels for line art
+MAX_SIZE = (1072, 1448)
+GRAY_LEVELS = 16
+JPEG_QUALITY = int(os.environ.get("EPUBBER_IMAGE_QUALITY", 60))
+# Images of one book together, the ones that don't fit anymore are left out (0: no images at all)
+DEFAULT_BUDGET_MB = float(os.environ.get("EPUBBER_IMAGE_BUDGET_MB", 8))
+# Threads recompressing images, Pillow releases the GIL while it decodes, scales and encodes
+IMAGE_WORKERS = int(os.environ.get("EPUBBER_IMAGE_WORKERS", min(4, os.cpu_count() or 1)))
+
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.gif')
+MEDIA_TYPES = {'.jpg': 'image/jpeg', '.png': 'image/png', '.gif': 'image/gif'}
+# Used without Pillow, the images are then kept as they are
+SIGNATURES = [(b'\xff\xd8\xff', '.jpg'), (b'\x89PNG\r\n\x1a\n', '.png'), (b'GIF87a', '.gif'), (b'GIF89a', '.gif')]
+
+IMG_TAG = re.compile(r'<img\b[^>]*>', re.IGNORECASE)
+SRC_ATTR = re.compile(r'\ssrc="([^"]*)"')
+# Stands in for a dropped image until the wrappers it leaves empty are gone
+DROPPED = '\x00'
+# A wrapper holding nothing but a dropped image (anchors with an id or name stay, links may point at them)
+EMPTIED = re.compile(r'<(p|div|center|span|b|i|em|strong|a)\b(?![^>]*\s(?:id|name)=)[^>]*>'
+                     r'(?:\s|&nbsp;|&#160;|\xa0|\x00)*\x00(?:\s|&nbsp;|&#160;|\xa0|\x00)*</\1>', re.IGNORECASE)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Thread pool shared by all builds of this process"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="images")
+        return _pool
+
+
+def recompress(data):
+    """
+    (data, suffix) of an image for e-ink readers: grayscale and scaled down to
+    MAX_SIZE. Drawings and diagrams (PNG, GIF) become 16 level PNGs, which
+    keeps lines sharp, photos become JPEGs. Without Pillow known formats
+    are kept as they are. Raises ValueError for anything that isn't an image.
+    """
+    if Image is None:
+        for signature, suffix in SIGNATURES:
+            if data.startswith(signature):
+                return data, suffix
+        raise ValueError("not a JPEG, PNG or GIF image")
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        line_art = image.format in ('PNG', 'GIF')
+        # JPEGs can be decoded at a fraction of their size right away
+        image.draft('L', MAX_SIZE)
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+            # Transparent parts are white on paper
+            image = image.convert('RGBA')
+            background = Image.new('RGBA', image.size, 'white')
+            image = Image.alpha_composite(background, image)
+        image = image.convert('L')
+        image.thumbnail(MAX_SIZE, Image.LANCZOS)
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ValueError(f"not a readable image ({e})")
+
+    out = io.BytesIO()
+    if line_art:
+        step = 256 // GRAY_LEVELS
+        image = image.point(lambda v: min(255, v // step * step + step // 2))
+        image.save(out, 'PNG', optimize=True)
+        return out.getvalue(), '.png'
+    image.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return out.getvalue(), '.jpg'
+
+
+class ImageAssets:
+    """
+    The images of one book.
+
+    rewrite() fetches the images a page refers to, concurrently through the
+    book's Fetcher (so through its session, page cache and politeness
+    budget), recompresses them for e-ink and points the page at them in
+    Images/. An image is stored once however many pages or URLs show it
+    (by the hash of its content). Once the book's images take up
+    `budget_mb`, further ones are left out, as are the ones that can't be
+    downloaded. Without a fetcher all images are left out.
+    """
+
+    def __init__(self, fetcher=None, budget_mb=DEFAULT_BUDGET_MB, progress=None):
+        self.fetcher = fetcher
+        self.budget = int(budget_mb * 1024**2)
+        self.progress = progress or Progress()
+        self.by_url = {}
+        self.by_hash = {}
+        self.items = []
+        self.pending = []
+        self.size = 0
+        self.dropped = 0
+
+    def _sources(self, body, page_url):
+        for tag in IMG_TAG.findall(body):
+            match = SRC_ATTR.search(tag)
+            if match and not match.group(1).startswith('data:'):
+                yield urljoin(page_url, unescape(match.group(1)).replace('\\', '/'))
+
+    def rewrite(self, body, page_url):
+        """body (a cleaned page from page_url) with its images in Images/, relative to Text/"""
+        new = [url for url in dict.fromkeys(self._sources(body, page_url)) if url not in self.by_url]
+        if new and self.fetcher is not None and self.budget > 0:
+            prepared = []
+            for url, response, error in self.fetcher.iter_fetch(new):
+                if error:
+                    self.progress.stats.image('failed')
+                    self.progress.error(f"Failed to download image {url}: {error}", stage='reformat', url=url)
+                    self.by_url[url] = None
+                    continue
+                data = response.content
+                digest = hashlib.sha256(data).hexdigest()[:16]
+                if digest in self.by_hash:
+                    self.progress.stats.image('duplicate')
+                    self.by_url[url] = self.by_hash[digest]
+                else:
+                    prepared.append((url, digest, get_pool().submit(recompress, data)))
+            for url, digest, future in prepared:
+                self.by_url[url] = self._add(url, digest, future)
+
+        def replace(match):
+            tag = match.group(0)
+            src = SRC_ATTR.search(tag)
+            name = self.by_url.get(urljoin(page_url, unescape(src.group(1)).replace('\\', '/'))) if src else None
+            if not name:
+                return DROPPED
+            return tag[:src.start(1)] + f"../Images/{name}" + tag[src.end(1):]
+
+        body = IMG_TAG.sub(replace, body)
+        if DROPPED in body:
+            # <p><img></p> would be left as an empty paragraph, same for nested wrappers
+            count = 1
+            while count:
+                body, count = EMPTIED.subn(DROPPED, body)
+            body = body.replace(DROPPED, '')
+        return body
+
+    def _add(self, url, digest, future):
+        try:
+            data, suffix = future.result()
+        except ValueError as e:
+            self.progress.stats.image('failed')
+            self.progress.error(f"Image {url} left out: {e}", stage='reformat', url=url)
+            return None
+        if digest in self.by_hash:
+            # The same image twice on one page
+            self.progress.stats.image('duplicate')
+            return self.by_hash[digest]
+        if self.size + len(data) > self.budget:
+            self.progress.stats.image('dropped')
+            self.dropped += 1
+            return None
+        name = digest + suffix
+        self.by_hash[digest] = name
+        self.size += len(data)
+        self.items.append(name)
+        self.pending.append((name, data))
+        self.progress.stats.image('added', len(data))
+        return name
+
+    def take(self):
+        """(name, data) of the images added since the last call"""
+        pending, self.pending = self.pending, []
+        return pending
+
+    def manifest_items(self):
+        """content.opf <item>s of all images"""
+        return [f'    <item id="img-{name}" href="Images/{name}" media-type="{MEDIA_TYPES[os.path.splitext(name)[1]]}"/>'
+                for name in self.items]
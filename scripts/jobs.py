@@ -0,0 +1,199 @@
+import time
+import uuid
+import threading
+from buildcache import normalize_url
+from metrics import BUILD_SECONDS
+
+JOB_TTL = 24 * 3600         # keep finished job status around this long
+JOB_TIMEOUT = 3600          # an in-flight marker older than this belongs to a dead worker
+WAIT_INTERVAL = 30          # how often a job waiting for a build outside the queue looks again, should its
+                            # owner never release the book (it is queued right away when the owner does)
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_QUEUED = 20
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    """
+    Redis backed build queue with a bounded pool of worker threads.
+
+    Jobs are pushed onto a Redis list and picked up by whichever worker
+    (in whichever gunicorn process) is free. Job status lives in a Redis
+    hash per job. A URL that is already queued or building gets the
+    existing job ID back instead of a second build. A URL that is being
+    built outside the queue (see claim) gets one job that waits for that
+    build, in a delayed set instead of a worker, and then picks up its
+    result.
+
+    `build(url, progress)` gets a Progress publishing to `events`
+    (a progress.LocalEvents or progress.RedisEvents broker).
+    """
+
+    def __init__(self, redis_client, build, events, workers=DEFAULT_WORKERS, max_queued=DEFAULT_MAX_QUEUED,
+                 prefix="epubber"):
+        self.redis = redis_client
+        self.build = build
+        self.events = events
+        self.workers = workers
+        self.max_queued = max_queued
+        self.prefix = prefix
+        self.queue_key = f"{prefix}:queue"
+        # Jobs waiting for a build outside the queue, scored by when to look again
+        self.delayed_key = f"{prefix}:delayed"
+        self._threads = []
+        self._stop = threading.Event()
+
+    def _job_key(self, job_id):
+        return f"{self.prefix}:job:{job_id}"
+
+    def _inflight_key(self, url):
+        return f"{self.prefix}:inflight:{normalize_url(url)}"
+
+    def _waiting_key(self, url):
+        return f"{self.prefix}:waiting:{normalize_url(url)}"
+
+    def _get(self, key):
+        value = self.redis.get(key)
+        return value.decode() if isinstance(value, bytes) else value
+
+    def submit(self, url):
+        """Queue a build of `url`, returns the job ID (an existing one if the URL is in flight)"""
+        inflight_key = self._inflight_key(url)
+        waiting_key = self._waiting_key(url)
+        while True:
+            waiting = self._get(waiting_key)
+            if waiting is not None and self.status(waiting).get('status') == 'queued':
+                return waiting
+            job_id = uuid.uuid4().hex
+            if self.redis.set(inflight_key, job_id, nx=True, ex=JOB_TIMEOUT):
+                marker_key = inflight_key
+                break
+            existing = self._get(inflight_key)
+            if existing is None:
+                continue
+            if ':' in existing:
+                # Claimed outside the queue, queue one job behind that build
+                if self.redis.set(waiting_key, job_id, nx=True, ex=JOB_TIMEOUT):
+                    marker_key = waiting_key
+                    break
+                continue
+            if self.status(existing).get('status') in ('queued', 'running'):
+                return existing
+            # Stale marker of a finished/lost job, take it over
+            self.redis.delete(inflight_key)
+
+        if self.redis.llen(self.queue_key) >= self.max_queued:
+            self.redis.delete(marker_key)
+            raise QueueFull("Too many books are being built right now, please try again in a few minutes")
+
+        job_key = self._job_key(job_id)
+        self.redis.hset(job_key, mapping={'url': url, 'status': 'queued', 'created': time.time(),
+                                          'waiting': int(marker_key == waiting_key)})
+        self.redis.expire(job_key, JOB_TTL)
+        if marker_key == waiting_key:
+            self.events.publisher(job_id).message("This book is being built already, waiting for it to finish")
+            self.redis.zadd(self.delayed_key, {job_id: time.time() + WAIT_INTERVAL})
+        else:
+            self.redis.lpush(self.queue_key, job_id)
+        return job_id
+
+    def claim(self, url, owner):
+        """
+        Mark url as being built by owner (outside the queue), False if it
+        already is. owner contains a ':' ('prebuild:<id>'), job IDs don't.
+        """
+        return bool(self.redis.set(self._inflight_key(url), owner, nx=True, ex=JOB_TIMEOUT))
+
+    def release(self, url, owner):
+        """
+        Drop the in-flight marker of url, but only if it is still owner's,
+        and queue the job waiting for it (if any)
+        """
+        inflight_key = self._inflight_key(url)
+        if self._get(inflight_key) != owner:
+            return
+        self.redis.delete(inflight_key)
+        waiting = self._get(self._waiting_key(url))
+        if waiting is not None:
+            self._wake(waiting)
+
+    def _wake(self, job_id):
+        """Move a delayed job into the queue, unless another worker or release() did already"""
+        if self.redis.zrem(self.delayed_key, job_id):
+            self.redis.lpush(self.queue_key, job_id)
+
+    def status(self, job_id):
+        """Dict with url, status (queued/running/done/failed), result or error; empty if unknown"""
+        data = self.redis.hgetall(self._job_key(job_id))
+        return {(k.decode() if isinstance(k, bytes) else k): (v.decode() if isinstance(v, bytes) else v)
+                for k, v in data.items()}
+
+    def depth(self):
+        """Jobs waiting to be built, in the queue or behind a build outside it"""
+        return self.redis.llen(self.queue_key) + self.redis.zcard(self.delayed_key)
+
+    def start(self):
+        """Start the worker threads (once per process)"""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"build-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+
+    def _work(self):
+        while not self._stop.is_set():
+            for job_id in self.redis.zrangebyscore(self.delayed_key, 0, time.time()):
+                self._wake(job_id.decode() if isinstance(job_id, bytes) else job_id)
+            item = self.redis.brpop(self.queue_key, timeout=5)
+            if item is None:
+                continue
+            job_id = item[1].decode() if isinstance(item[1], bytes) else item[1]
+            self._run(job_id)
+
+    def _take_over(self, job_id, url):
+        """
+        For a job waiting behind a build outside the queue: make it the job
+        building url once that build is done (it then finds the book in the
+        build cache). Until then it goes back into the delayed set, False.
+        """
+        if self.redis.set(self._inflight_key(url), job_id, nx=True, ex=JOB_TIMEOUT):
+            self.redis.delete(self._waiting_key(url))
+            self.redis.hset(self._job_key(job_id), 'waiting', 0)
+            return True
+        self.redis.zadd(self.delayed_key, {job_id: time.time() + WAIT_INTERVAL})
+        return False
+
+    def _timings(self, progress, start):
+        """Where the build spent its time, for the final event"""
+        return dict(progress.stats.summary(), total_seconds=round(time.perf_counter() - start, 3))
+
+    def _run(self, job_id):
+        job_key = self._job_key(job_id)
+        job = self.status(job_id)
+        url = job.get('url')
+        if not url:
+            return
+        if job.get('waiting') == '1' and not self._take_over(job_id, url):
+            return
+        self.redis.hset(job_key, mapping={'status': 'running', 'started': time.time()})
+        progress = self.events.publisher(job_id)
+        start = time.perf_counter()
+        try:
+            result = self.build(url, progress)
+            BUILD_SECONDS.observe(time.perf_counter() - start, result='done')
+            self.redis.hset(job_key, mapping={'status': 'done', 'result': str(result), 'finished': time.time()})
+            progress.emit('done', result=str(result), timings=self._timings(progress, start))
+        except Exception as e:
+            BUILD_SECONDS.observe(time.perf_counter() - start, result='failed')
+            error = str(e) or type(e).__name__
+            self.redis.hset(job_key, mapping={'status': 'failed', 'error': error, 'finished': time.time()})
+            progress.emit('failed', error=error, timings=self._timings(progress, start))
+        finally:
+            self.release(url, job_id)
@@ -0,0 +1,125 @@
+import os
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from progress import Progress
+
+DEFAULT_MAX_SIZE_GB = float(os.environ.get("EPUBBER_LIBRARY_GB", 1.0))
+# Evict down to this fraction of the maximum, so not every build has to evict
+LOW_WATER = 0.9
+# "lru" evicts the book downloaded longest ago, "lfu" the least downloaded one
+EVICTION = os.environ.get("EPUBBER_EVICTION", "lru")
+
+ORDER = {
+    'lru': "accessed_at ASC",
+    'lfu': "downloads ASC, accessed_at ASC",
+}
+
+
+class Library:
+    """
+    Index of the finished books in files/ with their size, last access and
+    download count.
+
+    The total size is kept up to date as books come and go, so checking
+    whether a new book fits never has to look at the folder. When it doesn't,
+    the least recently (or least frequently) downloaded books are deleted.
+    Paths are relative to `root_dir`, like the build cache's.
+    """
+
+    def __init__(self, root_dir, max_size_gb=DEFAULT_MAX_SIZE_GB, eviction=EVICTION):
+        self.root_dir = Path(root_dir)
+        self.max_size = int(max_size_gb * 1024**3)
+        self.min_size = int(self.max_size * LOW_WATER)
+        self.order = ORDER[eviction]
+        cache_dir = self.root_dir / "cache"
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(cache_dir / "library.sqlite", timeout=30, check_same_thread=False)
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS books (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                added_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                downloads INTEGER NOT NULL DEFAULT 0)""")
+            self.db.execute("CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL)")
+            created = self.db.execute("INSERT OR IGNORE INTO totals VALUES (0, 0)").rowcount
+        if created:
+            self._import_existing()
+
+    def _import_existing(self):
+        """First start: take over the books already in files/, their mtime as last access"""
+        files_dir = self.root_dir / "files"
+        if not files_dir.is_dir():
+            return
+        for path in files_dir.glob('*.epub'):
+            stat = path.stat()
+            self._insert(path.relative_to(self.root_dir), stat.st_size, stat.st_mtime)
+
+    def _insert(self, rel_path, size, accessed_at):
+        with self.lock, self.db:
+            row = self.db.execute("SELECT size FROM books WHERE path = ?", (os.fspath(rel_path),)).fetchone()
+            self.db.execute("""INSERT INTO books (path, size, added_at, accessed_at) VALUES (?, ?, ?, ?)
+                            ON CONFLICT(path) DO UPDATE SET size = excluded.size, added_at = excluded.added_at""",
+                            (os.fspath(rel_path), size, time.time(), accessed_at))
+            self.db.execute("UPDATE totals SET size = size + ? WHERE id = 0", (size - (row[0] if row else 0),))
+
+    def size(self):
+        with self.lock:
+            return self.db.execute("SELECT size FROM totals WHERE id = 0").fetchone()[0]
+
+    def fits(self, size=0):
+        """Whether `size` more bytes fit without evicting anything"""
+        return self.size() + size <= self.max_size
+
+    def add(self, rel_path, progress=None):
+        """Record a freshly built book, evicting others if the library got too big"""
+        size = (self.root_dir / rel_path).stat().st_size
+        self._insert(rel_path, size, time.time())
+        if not self.fits():
+            self.evict(keep=rel_path, progress=progress)
+
+    def touch(self, rel_path):
+        """A book was downloaded"""
+        with self.lock, self.db:
+            self.db.execute("UPDATE books SET accessed_at = ?, downloads = downloads + 1 WHERE path = ?",
+                            (time.time(), os.fspath(rel_path)))
+
+    def remove(self, rel_path):
+        with self.lock, self.db:
+            row = self.db.execute("SELECT size FROM books WHERE path = ?", (os.fspath(rel_path),)).fetchone()
+            if row:
+                self.db.execute("DELETE FROM books WHERE path = ?", (os.fspath(rel_path),))
+                self.db.execute("UPDATE totals SET size = size - ? WHERE id = 0", (row[0],))
+
+    def evict(self, keep=None, progress=None):
+        """Delete books, least recently/frequently downloaded first, until the library is below the low water mark"""
+        progress = progress or Progress()
+        current_size = self.size()
+        progress.message(f"Library size ({current_size/1024**3:.2f} GB) exceeds {self.max_size/1024**3:.2f} GB. Cleaning...")
+        with self.lock:
+            candidates = self.db.execute(f"SELECT path, size FROM books ORDER BY {self.order}").fetchall()
+
+        deleted_count = 0
+        for path, size in candidates:
+            if current_size <= self.min_size:
+                break
+            if keep is not None and path == os.fspath(keep):
+                continue
+            try:
+                (self.root_dir / path).unlink(missing_ok=True)
+            except OSError as e:
+                progress.error(f"Error deleting {path}: {e}")
+                continue
+            self.remove(path)
+            current_size -= size
+            deleted_count += 1
+            progress.message(f"Deleted: {Path(path).name} ({size/1024**2:.2f} MB)")
+
+        progress.message(f"Deleted {deleted_count} files. New size: {current_size/1024**3:.2f} GB")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,162 @@
+import json
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Optional
+from urllib.parse import urljoin, urldefrag
+from bs4 import BeautifulSoup
+from headings import german_fuzzy_match
+from buildcache import normalize_url
+
+HEADING_TAGS = ['h1', 'h2', 'h3', 'h4']
+SKIP_ENDINGS = ('.pdf', '.jpg', '.png', 'index.htm', 'index.html')
+INDEX_ENDINGS = ('index.htm', 'index.html', '/')
+
+
+@dataclass
+class Section:
+    title: str
+    url: str
+
+
+@dataclass
+class Chapter:
+    title: str  # '' for the sections before the first chapter heading, or after a sub-index link
+    sections: List[Section] = field(default_factory=list)
+    level: int = 1  # 2 for a part of a level 1 chapter, etc.
+    url: Optional[str] = None  # the sub-index page this chapter's sections are still to be read from
+
+
+@dataclass
+class BookManifest:
+    """Everything we know about a book after parsing its index page"""
+    url: str
+    title: str
+    author: str
+    date: str
+    subtitle: Optional[str] = None
+    chapters: List[Chapter] = field(default_factory=list)
+    index_pages: Dict[str, str] = field(default_factory=dict)  # sub-index URL: hash of the page
+
+    def sections(self):
+        """All sections in reading order, Section001 is the first"""
+        return [section for chapter in self.chapters for section in chapter.sections]
+
+    def to_json(self):
+        return json.dumps(asdict(self), ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        chapters = [Chapter(**dict(chapter, sections=[Section(**section) for section in chapter['sections']]))
+                    for chapter in data.pop('chapters')]
+        return cls(chapters=chapters, **data)
+
+
+def is_section_link(href):
+    """Links on an index page that point to a section of the book"""
+    # Skip anchor links and non-HTML files
+    return (not href.startswith(('#', 'mailto:', 'http', '..'))
+            and not href.endswith(SKIP_ENDINGS)
+            and 'translator.htm' not in href
+            and "#" not in href.split(".")[-1])
+
+
+def is_subindex_link(href):
+    """Links on an index page to the index page of a volume or part, below the book's folder"""
+    href = href.split('#')[0]
+    return (not href.startswith(('mailto:', 'http', '..', '/'))
+            and href.endswith(INDEX_ENDINGS) and href not in ('index.htm', 'index.html', './'))
+
+
+def extract_manifest(html, base_url, parser='html.parser'):
+    """
+    Parse an index page into a BookManifest, links are deduplicated.
+
+    Links to sub-index pages become chapters (one level below the heading
+    they are under) with their url set, see downloader.crawl_subindexes.
+    Section links after one go into an untitled chapter on the same level,
+    so they stay under the heading, after the volume, and not in it.
+    """
+    soup = BeautifulSoup(html, parser)
+
+    # Find author and title (always first h2 and h1 of page)
+    page_title = soup.title.string.strip() if soup.title and soup.title.string else "Datum unbekannt"
+    if page_title != "Datum unbekannt":
+        date_string = page_title.split("(")[-1]
+        date = date_string.split(")")[0]
+    else:
+        date = page_title
+    author = soup.find('h2').text
+    title_elem = soup.find('h1')
+    title = title_elem.text.replace("\n", "")
+    subtitle = None
+    potential_subtitle = title_elem.find_next(HEADING_TAGS)
+    if potential_subtitle:
+        subtitle = potential_subtitle.text
+        if german_fuzzy_match(subtitle, date, 50):
+            subtitle = None
+
+    manifest = BookManifest(url=base_url, title=title, author=author, date=date, subtitle=subtitle)
+
+    # Find all links between the markers, without an info paragraph start after the title
+    start_marker = soup.select_one('p.info, p.information, p.fst') or title_elem
+    end_marker = soup.find('p', {'class': 'updat'})
+
+    chapter = heading = Chapter('')
+    manifest.chapters.append(chapter)
+    seen = {base_url}
+    book_dir = urljoin(base_url, '.') if base_url else None
+    current_element = start_marker.find_next()
+    while current_element and current_element != end_marker:
+        if current_element.name == 'a' and current_element.get('href'):
+            href = current_element['href'].replace('\\', '/')
+            # Folder links ('band1/') would pass as sections too
+            if book_dir and is_subindex_link(href):
+                absolute_url = urldefrag(urljoin(base_url, href))[0]
+                if absolute_url not in seen and absolute_url != book_dir:
+                    seen.add(absolute_url)
+                    # Volumes are parts of the chapter whose heading they are under
+                    level = heading.level + 1 if heading.title else heading.level
+                    chapter = Chapter(current_element.text, level=level, url=absolute_url)
+                    manifest.chapters.append(chapter)
+            elif is_section_link(href):
+                absolute_url = urljoin(base_url, href) if base_url else href
+                if absolute_url not in seen:  # Don't include a page (or the main page) twice
+                    seen.add(absolute_url)
+                    if chapter.url:
+                        chapter = Chapter('', level=chapter.level)
+                        manifest.chapters.append(chapter)
+                    chapter.sections.append(Section(current_element.text, absolute_url))
+        elif current_element.name in HEADING_TAGS and not current_element.text.lower().startswith("content"):
+            chapter = heading = Chapter(current_element.text)
+            manifest.chapters.append(chapter)
+        current_element = current_element.find_next()
+
+    return manifest
+
+
+BOOK_INDEXES = ('/index.htm', '/index.html', '/')
+
+
+def extract_book_links(html, base_url, parser='html.parser'):
+    """
+    Links to the books on an author's page (or any list of works), in page
+    order: index pages and folders below the page's own folder. Other
+    authors and subject pages linked from there are left out, spellings of
+    the same URL (http/https, with or without index.htm) are taken once.
+    """
+    soup = BeautifulSoup(html, parser)
+    page_dir = normalize_url(urljoin(base_url, '.'))
+    books = []
+    seen = {normalize_url(base_url), page_dir}
+    for link in soup.find_all('a', href=True):
+        href = link['href'].replace('\\', '/').split('#')[0]
+        if not href or href.startswith('mailto:'):
+            continue
+        url = urljoin(base_url, href)
+        if not url.endswith(BOOK_INDEXES):
+            continue
+        key = normalize_url(url)
+        if key.startswith(page_dir) and key not in seen:
+            seen.add(key)
+            books.append(url)
+    return books
@@ -0,0 +1,223 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# Histogram buckets in seconds, from a cached page to a huge book
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class Metric:
+    """
+    A Prometheus style metric family with optional labels.
+
+    Values live in this process only. With several gunicorn workers every
+    worker serves its own numbers, scrape them per worker (or run one).
+    """
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def _label_text(self, key, extra=None):
+        pairs = list(zip(self.labels, key)) + ([extra] if extra else [])
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{self._label_text(key)} {_number(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A gauge, optionally read from a callback at scrape time"""
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), callback=None):
+        super().__init__(name, help, labels)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def render(self):
+        if self.callback:
+            try:
+                self.set(self.callback())
+            except Exception:
+                pass
+        return super().render()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{self._label_text(key, ('le', _number(bound)))} {bucket}")
+                lines.append(f"{self.name}_bucket{self._label_text(key, ('le', '+Inf'))} {count}")
+                lines.append(f"{self.name}_sum{self._label_text(key)} {_number(total)}")
+                lines.append(f"{self.name}_count{self._label_text(key)} {count}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REGISTRY = []
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Download
+FETCH_SECONDS = Histogram("epubber_fetch_seconds", "Latency of requests to marxists.org (per attempt)")
+FETCH_BYTES = Counter("epubber_fetch_bytes_total", "Bytes downloaded from marxists.org")
+FETCH_RETRIES = Counter("epubber_fetch_retries_total", "Requests that were retried")
+FETCH_ERRORS = Counter("epubber_fetch_errors_total", "Pages that could not be downloaded")
+HTTP_CACHE = Counter("epubber_http_cache_total", "Page lookups in the HTTP cache", ["result"])
+# Reformat
+SECTION_SECONDS = Histogram("epubber_section_seconds", "Time spent per section and step", ["step"])
+SECTION_ERRORS = Counter("epubber_section_errors_total", "Sections that could not be converted")
+SHARED_CACHE = Counter("epubber_shared_cache_total", "Lookups of cleaned sections and manifests by cache level",
+                       ["kind", "result"])
+IMAGES = Counter("epubber_images_total", "Images referenced by the books, by what became of them", ["result"])
+# Packaging
+PACKAGE_SECONDS = Histogram("epubber_package_seconds", "Time spent compressing and writing a book")
+EPUB_BYTES = Counter("epubber_epub_bytes_total", "Size of the books built")
+# Builds
+STAGE_SECONDS = Histogram("epubber_stage_seconds", "Time spent per build stage", ["stage"])
+BUILD_SECONDS = Histogram("epubber_build_seconds", "Duration of whole builds", ["result"])
+PREBUILDS = Counter("epubber_prebuilds_total", "Background builds of popular books", ["result"])
+BUILD_CACHE = Counter("epubber_build_cache_total", "Build requests by how the build cache answered", ["result"])
+
+
+class BuildStats:
+    """
+    Timings and counters of one build, summed up per name, for the summary
+    in the job's final event. Everything recorded here also feeds the
+    process wide metrics above.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, stage):
+        """Time a whole stage (download, reformat, package)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            STAGE_SECONDS.observe(seconds, stage=stage)
+            self.add(f"{stage}_seconds", seconds)
+
+    def request(self, seconds):
+        """One request to marxists.org (one attempt)"""
+        FETCH_SECONDS.observe(seconds)
+        self.add('requests')
+        self.add('request_seconds', seconds)
+
+    def page(self, size, from_cache=False):
+        """One page handed to the pipeline"""
+        if not from_cache:
+            FETCH_BYTES.inc(size)
+        self.add('fetch_bytes', size)
+        self.add('pages_cached' if from_cache else 'pages_fetched')
+
+    def retry(self):
+        FETCH_RETRIES.inc()
+        self.add('fetch_retries')
+
+    def fetch_failed(self):
+        FETCH_ERRORS.inc()
+        self.add('pages_failed')
+
+    def cache(self, result):
+        HTTP_CACHE.inc(result=result)
+
+    def section(self, timings, error=None):
+        """timings: {step: seconds} of one section, as clean_section measures them"""
+        for step, seconds in timings.items():
+            SECTION_SECONDS.observe(seconds, step=step)
+            self.add(f"section_{step}_seconds", seconds)
+        if error:
+            SECTION_ERRORS.inc()
+            self.add('sections_failed')
+
+    def image(self, result, size=0):
+        """result: added, duplicate, dropped (over the budget) or failed"""
+        IMAGES.inc(result=result)
+        self.add(f"images_{result}")
+        if size:
+            self.add('image_bytes', size)
+
+    def package(self, seconds, size):
+        PACKAGE_SECONDS.observe(seconds)
+        EPUB_BYTES.inc(size)
+        self.add('zip_seconds', seconds)
+        self.add('epub_bytes', size)
+
+    def get(self, name, default=0):
+        with self.lock:
+            return self.values.get(name, default)
+
+    def summary(self):
+        """The recorded values, seconds rounded to milliseconds"""
+        with self.lock:
+            return {name: round(value, 3) if isinstance(value, float) else value
+                    for name, value in sorted(self.values.items())}
@@ -0,0 +1,231 @@
+"""
+Keep the most requested books built, so they are served from files/ right away.
+
+The web app counts the book URLs it is asked for (Popularity). A background
+thread (Prebuilder) rebuilds the top books during off-peak hours: books
+whose build is missing or getting old are built again, with the sources
+checked against the last build, so an unchanged book costs little more
+than the conditional requests for its pages. The requests the prebuilds
+make to marxists.org per day are capped.
+
+    python prebuild.py        build the due top books now, regardless of the hour
+"""
+import os
+import time
+import uuid
+import threading
+from datetime import datetime
+from pathlib import Path
+from buildcache import BuildCache, normalize_url
+from fetcher import Fetcher, share_budgets
+from httpcache import HttpCache
+from progress import Progress
+from processer import from_url
+from metrics import PREBUILDS
+
+# Books kept built
+DEFAULT_TOP = int(os.environ.get("EPUBBER_PREBUILD_TOP", 30))
+# Local hours (start-end, end excluded, may wrap around midnight) the prebuilds run in
+DEFAULT_HOURS = os.environ.get("EPUBBER_PREBUILD_HOURS", "2-6")
+# Requests to marxists.org the prebuilds may make per day
+DEFAULT_BUDGET = int(os.environ.get("EPUBBER_PREBUILD_BUDGET", 2000))
+# Gentler than a user's build, nobody is waiting for these
+PREBUILD_RATE = float(os.environ.get("EPUBBER_PREBUILD_RATE", 1.0))
+# Builds younger than this are left alone, so last night's ones get rebuilt before they expire
+REVALIDATE_AFTER = 12 * 3600
+# Counts are halved once a day, so the ranking follows what is asked for now
+DECAY_INTERVAL = 24 * 3600
+CHECK_INTERVAL = 300
+
+
+def parse_hours(hours):
+    start, end = (int(hour) for hour in hours.split('-'))
+    return start, end
+
+
+def off_peak(hours, now=None):
+    start, end = parse_hours(hours)
+    hour = (now or datetime.now()).hour
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+
+class Popularity:
+    """Request counts per book, in Redis so every web node adds to the same ranking"""
+
+    def __init__(self, redis_client, prefix="epubber"):
+        self.redis = redis_client
+        self.scores_key = f"{prefix}:popular"
+        self.urls_key = f"{prefix}:popular:urls"
+        self.decayed_key = f"{prefix}:popular:decayed"
+
+    def record(self, url):
+        key = normalize_url(url)
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zincrby(self.scores_key, 1, key)
+            # Builds need a URL as it was asked for, not the normalized one
+            pipe.hset(self.urls_key, key, url)
+            pipe.execute()
+
+    def top(self, n):
+        """[(url, score)] of the n most requested books"""
+        keys = self.redis.zrevrange(self.scores_key, 0, n - 1, withscores=True)
+        if not keys:
+            return []
+        urls = self.redis.hmget(self.urls_key, [key for key, _ in keys])
+        return [(url.decode() if isinstance(url, bytes) else url, score)
+                for url, (_, score) in zip(urls, keys) if url]
+
+    def decay(self):
+        """Halve all counts, once per DECAY_INTERVAL across all nodes"""
+        if not self.redis.set(self.decayed_key, time.time(), nx=True, ex=DECAY_INTERVAL):
+            return
+        self.redis.zunionstore(self.scores_key, {self.scores_key: 0.5})
+        # Books nobody asks for anymore drop out
+        gone = self.redis.zrangebyscore(self.scores_key, 0, 0.1)
+        if gone:
+            self.redis.zrem(self.scores_key, *gone)
+            self.redis.hdel(self.urls_key, *gone)
+
+
+class Prebuilder:
+    """
+    Background thread keeping the `top` most popular books built.
+
+    Only runs within the off-peak `hours` and while the build queue is empty
+    (`busy` says whether it is), one book at a time and only on one node at
+    a time. A book a user is building at the moment is skipped, the
+    JobQueue's in-flight markers tell. The requests of each prebuild count
+    against the daily `budget`, a book whose last build cost more than is
+    left waits for the next day, as does a book whose prebuild failed.
+
+    `build(url, progress, fetcher)` builds the book, checking its sources
+    even if the last build is recent.
+    """
+
+    def __init__(self, redis_client, popularity, build, job_queue=None, root_dir=None, top=DEFAULT_TOP,
+                 hours=DEFAULT_HOURS, budget=DEFAULT_BUDGET, busy=None, progress=None, prefix="epubber"):
+        self.redis = redis_client
+        self.popularity = popularity
+        self.build = build
+        self.job_queue = job_queue
+        self.root_dir = Path(root_dir or Path(__file__).parent.parent.resolve())
+        self.top = top
+        self.hours = hours
+        self.budget = budget
+        self.busy = busy or (lambda: False)
+        self.progress = progress or Progress()
+        self.lock_key = f"{prefix}:prebuild:lock"
+        self.costs_key = f"{prefix}:prebuild:costs"
+        self.failed_key = f"{prefix}:prebuild:failed"
+        self.prefix = prefix
+        self.owner = f"prebuild:{uuid.uuid4().hex}"
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _spent_key(self):
+        return f"{self.prefix}:prebuild:spent:{time.strftime('%Y-%m-%d')}"
+
+    def remaining(self):
+        """Requests left in today's budget"""
+        return self.budget - int(self.redis.get(self._spent_key()) or 0)
+
+    def start(self):
+        """Start the scheduler thread (once per process)"""
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._loop, name="prebuild", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(CHECK_INTERVAL):
+            try:
+                self.popularity.decay()
+                if off_peak(self.hours) and not self.busy():
+                    self.run()
+            except Exception as e:
+                self.progress.error(f"Prebuild failed: {str(e) or type(e).__name__}")
+
+    def due(self, url):
+        """Whether url has no build, or one old enough to be checked again"""
+        if self.redis.exists(f"{self.failed_key}:{normalize_url(url)}"):
+            return False
+        build_cache = BuildCache(self.root_dir)
+        try:
+            age = build_cache.age(url)
+        finally:
+            build_cache.close()
+        return age is None or age > REVALIDATE_AFTER
+
+    def run(self, force=False):
+        """
+        Build the popular books that are due, while it is off-peak, nothing
+        else is going on and the budget lasts (force: regardless of hours and
+        queue). Returns the URLs built.
+        """
+        # Held for as long as a prebuild may take, and given back when done
+        if not self.redis.set(self.lock_key, self.owner, nx=True, ex=3600):
+            return []
+        built = []
+        try:
+            for url, score in self.popularity.top(self.top):
+                if self._stop.is_set() or not force and (not off_peak(self.hours) or self.busy()):
+                    break
+                if not self.due(url):
+                    continue
+                cost = int(self.redis.hget(self.costs_key, normalize_url(url)) or 1)
+                if cost > self.remaining():
+                    PREBUILDS.inc(result='budget')
+                    continue
+                if self.job_queue and not self.job_queue.claim(url, self.owner):
+                    continue
+                try:
+                    if self._build(url, score):
+                        built.append(url)
+                finally:
+                    if self.job_queue:
+                        self.job_queue.release(url, self.owner)
+                self.redis.expire(self.lock_key, 3600)
+        finally:
+            if self.redis.get(self.lock_key) in (self.owner, self.owner.encode()):
+                self.redis.delete(self.lock_key)
+        return built
+
+    def _build(self, url, score):
+        progress = Progress()
+        progress.publish = lambda event: None
+        self.progress.message(f"Prebuilding {url} ({score:g} requests)")
+        cache = HttpCache(os.path.join(self.root_dir, "cache", "http"))
+        try:
+            with Fetcher(cache=cache, rate=PREBUILD_RATE, max_in_flight=1, stats=progress.stats) as fetcher:
+                result = self.build(url, progress, fetcher)
+            PREBUILDS.inc(result='done')
+            self.progress.message(f"Prebuilt {result}")
+            return True
+        except Exception as e:
+            PREBUILDS.inc(result='failed')
+            self.redis.set(f"{self.failed_key}:{normalize_url(url)}", time.time(), ex=DECAY_INTERVAL)
+            self.progress.error(f"Prebuild of {url} failed: {str(e) or type(e).__name__}")
+            return False
+        finally:
+            cost = progress.stats.get('requests')
+            with self.redis.pipeline(transaction=False) as pipe:
+                pipe.incrby(self._spent_key(), cost)
+                pipe.expire(self._spent_key(), 2 * 24 * 3600)
+                pipe.hset(self.costs_key, normalize_url(url), max(cost, 1))
+                pipe.execute()
+
+
+def prebuild(url, progress, fetcher):
+    """Build for the Prebuilder: sources are checked even if the last build is recent"""
+    return from_url(url, progress, pipeline="batch", fetcher=fetcher, revalidate=True)
+
+
+if __name__ == "__main__":
+    import redis
+    redis_client = redis.Redis.from_url(os.environ.get("EPUBBER_REDIS_URL", "redis://localhost:6379/0"))
+    share_budgets(redis_client)
+    built = Prebuilder(redis_client, Popularity(redis_client), prebuild).run(force=True)
+    print(f"Built {len(built)} books")
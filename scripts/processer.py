@@ -1,20 +1,210 @@
 import os
 import sys
+import threading
+import tempfile
+from contextlib import contextmanager
 from pathlib import Path
-from downloader import download_book
-from reformat import reformat
-from epubber import create_epub
+from downloader import download_book, fetch_index, iter_sections, index_hash
+from reformat import reformat, iter_book_pages
+from epubber import create_epub, stream_epub, epub_filename
+from buildcache import BuildCache
+from library import Library
+from fetcher import Fetcher
+from httpcache import HttpCache
+from progress import Progress
+from metrics import BUILD_CACHE
+from bookfiles import MemoryFiles
 
-def from_url(base_url):
+# Keep the files of a book in memory while building it (no intermediate
+# files at all), EPUBBER_IN_MEMORY=0 builds in a temporary folder instead
+IN_MEMORY = os.environ.get("EPUBBER_IN_MEMORY", "1") != "0"
+
+# "stream" builds books section by section with bounded memory, "batch"
+# downloads the whole book first (and skips rebuilding if the sources didn't change)
+PIPELINE = os.environ.get("EPUBBER_PIPELINE", "stream")
+
+@contextmanager
+def build_workspace(in_memory):
+    """Scratch space for one build, templates, Styles and META-INF are shared read-only from the repo root"""
+    if in_memory:
+        yield MemoryFiles()
+    else:
+        with tempfile.TemporaryDirectory(prefix="epubber-") as workspace:
+            yield workspace
+
+@contextmanager
+def build_fetcher(root_dir, progress, fetcher=None):
+    """The given (shared) fetcher, or a fresh one with the page cache for this build"""
+    if fetcher is not None:
+        yield fetcher
+        return
+    with Fetcher(cache=HttpCache(os.path.join(root_dir, "cache", "http")), stats=progress.stats) as fetcher:
+        yield fetcher
+
+def is_complete(manifest, progress):
+    """
+    Whether all sections of the book made it. An incomplete book is still
+    delivered, but loudly and not cached, so the next request tries again.
+    """
+    missing = progress.stats.get('sections_missing')
+    if missing:
+        progress.error(f"The book is incomplete: {missing} of {len(manifest.sections())} sections could not be "
+                       f"downloaded, it will be rebuilt on the next request", stage='download')
+    return not missing
+
+def cached_build(base_url):
+    """Path of an already built, still fresh EPUB for this URL, or None"""
+    root_dir = Path(__file__).parent.parent.resolve()
+    build_cache = BuildCache(root_dir)
+    try:
+        fpath = build_cache.lookup(base_url)
+        if fpath:
+            BUILD_CACHE.inc(result='hit')
+        return fpath
+    finally:
+        build_cache.close()
+
+def add_to_library(root_dir, fpath, progress=None):
+    """Account for a new book in files/, making room if the library is full"""
+    library = Library(root_dir)
+    try:
+        library.add(fpath, progress)
+    finally:
+        library.close()
+
+def write_streamed(chunks, output_dir, filename):
+    """
+    Pass the chunks of a book through while saving them to output_dir/filename,
+    the file only appears once the book is complete
+    """
+    output_dir.mkdir(exist_ok=True)
+    # Build under a temporary name, so concurrent builds of the same book
+    # never see (or serve) a half written file
+    tmp_path = output_dir / f".{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as book:
+            for chunk in chunks:
+                book.write(chunk)
+                yield chunk
+        os.replace(tmp_path, output_dir / filename)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+def iter_build(base_url, html, manifest, progress=None, fetcher=None, profile=None):
+    """
+    The streaming pipeline: every section flows fetch -> clean -> template -> zip
+    on its own, with only a bounded window of sections in flight.
+
+    Yields the EPUB in chunks, saves it to files/ and records it in the build
+    cache once it is complete. Memory use doesn't grow with the size of the book.
+    """
+    progress = progress or Progress()
+    script_dir = Path(__file__).parent.resolve()
+    root_dir = script_dir.parent.resolve()
+    output_dir = root_dir / "files"
+    filename = epub_filename(manifest)
+
+    build_cache = BuildCache(root_dir)
+    try:
+        source_hash = index_hash(html, manifest)
+        # Download, reformat and packaging overlap here, so they are one stage
+        with progress.stats.stage('stream'), \
+                build_fetcher(root_dir, progress, fetcher) as client:
+            sources = iter_sections(manifest, client, source_hash, progress)
+            pages = iter_book_pages(script_dir, manifest, sources, progress=progress, fetcher=client)
+            yield from write_streamed(stream_epub(pages, root_dir, progress, profile), output_dir, filename)
+
+        fpath = Path("files") / filename
+        if is_complete(manifest, progress):
+            build_cache.store(base_url, source_hash.hexdigest(), fpath)
+        add_to_library(root_dir, fpath, progress)
+        progress.message(f"Successfully created EPUB: {fpath}")
+    finally:
+        build_cache.close()
+
+def from_url(base_url, progress=None, in_memory=IN_MEMORY, pipeline=PIPELINE, fetcher=None, profile=None,
+             revalidate=False):
+    """
+    Build the book at base_url (unless a recent enough build exists), returns
+    the path of the EPUB relative to the repo root. Pass a fetcher to share
+    its connections and page cache between builds (the politeness budget
+    per host is shared by all fetchers anyway).
+    profile picks the zip compression (see zipwriter.PROFILES). revalidate
+    checks the sources of a recent build too instead of reusing it.
+    """
+    progress = progress or Progress()
     script_dir = Path(__file__).parent.resolve()
     root_dir = script_dir.parent.resolve()
 
-    download_book(root_dir, base_url)
+    build_cache = BuildCache(root_dir)
+    try:
+        fpath = None if revalidate else build_cache.lookup(base_url)
+        if fpath:
+            BUILD_CACHE.inc(result='hit')
+            progress.message(f"Book was built recently, reusing {fpath}")
+            return fpath
+
+        if pipeline == "stream":
+            BUILD_CACHE.inc(result='miss')
+            with progress.stats.stage('index'), \
+                    build_fetcher(root_dir, progress, fetcher) as client:
+                html, manifest = fetch_index(client, base_url, progress)
+            for _ in iter_build(base_url, html, manifest, progress, fetcher, profile):
+                pass
+            return Path("files") / epub_filename(manifest)
+
+        # Every build gets its own workspace
+        with build_workspace(in_memory) as workspace:
+            with progress.stats.stage('download'), \
+                    build_fetcher(root_dir, progress, fetcher) as client:
+                manifest, source_hash = download_book(workspace, base_url, client, progress)
+
+            # Sources did not change since the last build, no need to rebuild
+            fpath = build_cache.lookup_sources(base_url, source_hash)
+            if fpath:
+                BUILD_CACHE.inc(result='sources')
+                progress.message(f"Sources unchanged, reusing {fpath}")
+                return fpath
+            BUILD_CACHE.inc(result='miss')
 
-    reformat(script_dir, os.path.join(root_dir, "Text", "index.html"))
+            with progress.stats.stage('reformat'), \
+                    build_fetcher(root_dir, progress, fetcher) as client:
+                reformat(script_dir, manifest, workspace, progress, fetcher=client)
 
-    fpath = create_epub(root_dir)
-    return fpath
+            with progress.stats.stage('package'):
+                fpath = create_epub(workspace, static_dir=root_dir, progress=progress, manifest=manifest,
+                                    profile=profile)
+            if is_complete(manifest, progress):
+                build_cache.store(base_url, source_hash, fpath)
+            add_to_library(root_dir, fpath, progress)
+            return fpath
+    finally:
+        build_cache.close()
+
+def stream_from_url(base_url, progress=None, profile=None):
+    """
+    Build the book and send it while it is being built.
+
+    Only the main page is downloaded up front (for the file name), returns the
+    file name and a generator of EPUB chunks that does the rest of the build.
+    """
+    progress = progress or Progress()
+    root_dir = Path(__file__).parent.parent.resolve()
+    BUILD_CACHE.inc(result='miss')
+    with progress.stats.stage('index'), \
+            build_fetcher(root_dir, progress) as client:
+        html, manifest = fetch_index(client, base_url, progress)
+
+    def chunks():
+        try:
+            yield from iter_build(base_url, html, manifest, progress, profile=profile)
+        except Exception as e:
+            # Too late for an error page, the client gets a truncated download
+            progress.error(f"Error streaming book: {str(e)}")
+            raise
+
+    return epub_filename(manifest), chunks()
 
 
 if __name__ == "__main__":
@@ -23,4 +213,8 @@ if __name__ == "__main__":
         sys.exit(1)
 
     base_url = sys.argv[1]
-    from_url(base_url)
+    try:
+        from_url(base_url)
+    except Exception as e:
+        print(f"Build failed: {str(e) or type(e).__name__}")
+        sys.exit(1)
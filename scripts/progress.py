@@ -0,0 +1,212 @@
+import json
+import time
+import logging
+import threading
+from metrics import BuildStats
+
+EVENTS_TTL = 3600  # keep a job's event log around for late subscribers
+PRUNE_INTERVAL = 60  # how often LocalEvents looks for logs past EVENTS_TTL
+FINAL_EVENTS = ('done', 'failed')
+
+
+class Progress:
+    """
+    Progress reporter that is handed through the pipeline.
+
+    Every event is a dict with a `type`:
+      message  - free text (what used to be a print)
+      stage    - a new pipeline stage starts (download, reformat, package)
+      progress - item i of total in the current stage, optionally with url and bytes
+      error    - a non fatal error (e.g. one section failed to download)
+      done     - the book is ready, `result` is its path
+      failed   - the build failed, `error` says why
+    This base class prints the events, which is what the command line tools want.
+
+    `stats` collects the timings of the build (see metrics.BuildStats).
+    """
+
+    @property
+    def stats(self):
+        if '_stats' not in self.__dict__:
+            self._stats = BuildStats()
+        return self._stats
+
+    def emit(self, type, **fields):
+        event = dict(fields, type=type, time=time.time())
+        self.publish(event)
+        return event
+
+    def publish(self, event):
+        text = format_event(event)
+        if text is not None:
+            print(text)
+
+    def message(self, text):
+        self.emit('message', text=text)
+
+    def stage(self, stage, text=None):
+        self.emit('stage', stage=stage, text=text)
+
+    def item(self, stage, i, total, url=None, bytes=None, text=None):
+        self.emit('progress', stage=stage, i=i, total=total, url=url, bytes=bytes, text=text)
+
+    def error(self, text, stage=None, url=None):
+        self.emit('error', text=text, stage=stage, url=url)
+
+
+def format_event(event):
+    """Human readable line for an event"""
+    if event.get('text'):
+        return event['text']
+    if event['type'] == 'progress':
+        line = f"{event['stage'].capitalize()} {event['i']}/{event['total']}"
+        return f"{line}: {event['url']}" if event.get('url') else line
+    if event['type'] == 'done':
+        return f"Finished: {event['result']}"
+    if event['type'] == 'failed':
+        return f"Failed: {event['error']}"
+    return None
+
+
+class LogProgress(Progress):
+    """
+    Progress of a build nobody follows event by event (e.g. a streamed one):
+    the events go to the `epubber` logger instead of stdout, errors as
+    warnings.
+    """
+
+    logger = logging.getLogger("epubber")
+
+    def publish(self, event):
+        text = format_event(event)
+        if text is not None:
+            self.logger.log(logging.WARNING if event['type'] in ('error', 'failed') else logging.DEBUG, text)
+
+
+class LocalEvents:
+    """
+    In-process event broker: one append-only event log per job.
+
+    Only works if the job runs in the same process as the subscriber,
+    use RedisEvents with more than one worker process. Like the Redis logs,
+    a job's log goes EVENTS_TTL after its last event.
+    """
+
+    def __init__(self):
+        self.logs = {}
+        self.updated = {}
+        self.next_prune = time.monotonic() + PRUNE_INTERVAL
+        self.cond = threading.Condition()
+
+    def publisher(self, job_id):
+        return _Publisher(self, job_id)
+
+    def publish(self, job_id, event):
+        with self.cond:
+            log = self.logs.setdefault(job_id, [])
+            event['seq'] = len(log) + 1
+            log.append(event)
+            now = time.monotonic()
+            self.updated[job_id] = now
+            if now >= self.next_prune:
+                self._prune(now)
+            self.cond.notify_all()
+
+    def _prune(self, now):
+        for job_id in [job_id for job_id, updated in self.updated.items() if now - updated > EVENTS_TTL]:
+            del self.logs[job_id]
+            del self.updated[job_id]
+        self.next_prune = now + PRUNE_INTERVAL
+
+    def subscribe(self, job_id, idle_timeout=None):
+        """
+        Yields all events of the job (including past ones) until it is done or
+        failed, or nothing happened for `idle_timeout` seconds.
+        """
+        seen = 0
+        while True:
+            # Events of other jobs wake us up too, the deadline is this job's own
+            deadline = None if idle_timeout is None else time.monotonic() + idle_timeout
+            with self.cond:
+                while len(self.logs.get(job_id, ())) <= seen:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return
+                    self.cond.wait(remaining)
+                log = self.logs[job_id]
+                new, seen = log[seen:], len(log)
+            for event in new:
+                yield event
+                if event['type'] in FINAL_EVENTS:
+                    return
+
+
+class RedisEvents:
+    """
+    Event broker over Redis, so any gunicorn worker can stream any job.
+
+    Events are appended to a per-job list (for subscribers that show up
+    late) and published on a per-job pub/sub channel.
+    """
+
+    def __init__(self, redis_client, prefix="epubber"):
+        self.redis = redis_client
+        self.prefix = prefix
+
+    def _log_key(self, job_id):
+        return f"{self.prefix}:events:{job_id}"
+
+    def _channel(self, job_id):
+        return f"{self.prefix}:events-channel:{job_id}"
+
+    def publisher(self, job_id):
+        return _Publisher(self, job_id)
+
+    def publish(self, job_id, event):
+        log_key = self._log_key(job_id)
+        event['seq'] = self.redis.rpush(log_key, json.dumps(event))
+        self.redis.expire(log_key, EVENTS_TTL)
+        self.redis.publish(self._channel(job_id), json.dumps(event))
+
+    def subscribe(self, job_id, idle_timeout=None):
+        """
+        Yields all events of the job (including past ones) until it is done or
+        failed, or nothing happened for `idle_timeout` seconds.
+        """
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        # Subscribe before replaying the log, so nothing falls through the gap
+        pubsub.subscribe(self._channel(job_id))
+        try:
+            seen = 0
+            for seen, raw in enumerate(self.redis.lrange(self._log_key(job_id), 0, -1), 1):
+                # The position in the log is the sequence number
+                event = dict(json.loads(raw), seq=seen)
+                yield event
+                if event['type'] in FINAL_EVENTS:
+                    return
+            last_event = time.monotonic()
+            while idle_timeout is None or time.monotonic() - last_event < idle_timeout:
+                message = pubsub.get_message(timeout=1.0)
+                if message is None:
+                    continue
+                event = json.loads(message['data'])
+                if event['seq'] <= seen:
+                    continue
+                seen = event['seq']
+                last_event = time.monotonic()
+                yield event
+                if event['type'] in FINAL_EVENTS:
+                    return
+        finally:
+            pubsub.close()
+
+
+class _Publisher(Progress):
+    """Progress that sends the events of one job to a broker"""
+
+    def __init__(self, broker, job_id):
+        self.broker = broker
+        self.job_id = job_id
+
+    def publish(self, event):
+        self.broker.publish(self.job_id, event)
@@ -1,339 +1,548 @@
 import os
 import re
 import sys
-from fuzzywuzzy import fuzz
+import time
+import threading
+from collections import deque
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, Future
+from html import escape
 from pathlib import Path
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin
-
-def german_fuzzy_match(text1, text2, threshold=85):
-    """Special handling for German grammatical variations"""
-    # Normalize common German variations
-    replacements = {
-        r'\bder\b': '(der|des|dem|den)',  # Articles
-        r'\bdas\b': '(das|dem|des)',
-        r'\bdie\b': '(die|der|den)',
-        r'\bein\b': '(ein|einen|eines|einem|einer)',
-        r'(\w+)s\b': r'\1(s|es)?'  # Genitive/plural forms
-    }
-
-    # Create flexible patterns
-    pattern1 = text1.lower()
-    pattern2 = text2.lower()
-
-    for rgx, replacement in replacements.items():
-        pattern1 = re.sub(rgx, replacement, pattern1)
-        pattern2 = re.sub(rgx, replacement, pattern2)
-
-    # Check direct match with normalized patterns
-    if re.fullmatch(pattern1, text2.lower()) or re.fullmatch(pattern2, text1.lower()):
-        return True
-
-    # Fallback to fuzzy matching
-    return fuzz.token_set_ratio(text1, text2) >= threshold
-
-def generate_epub_toc(toc_data, template_path, output_path, title):
+from bs4 import BeautifulSoup, NavigableString, Comment, Tag
+from progress import Progress
+from headings import HeadingIndex
+from manifest import extract_manifest
+from bookfiles import as_files, source_name
+from templating import load_template
+from sharedcache import default_cache
+from images import ImageAssets, IMAGE_SUFFIXES
+
+def generate_epub_toc(chapters, template_path, output_path, title):
     """
     Generates an EPUB navigation file with unnumbered/unbulleted TOC
 
     Args:
-        toc_data: Dictionary like {'':[sec1,sec2], 'chapter1':[sec3,sec4]}
+        chapters: The manifest.Chapter list of the book, a chapter titled ''
+                  holds the sections before the first chapter (prefaces, etc.)
+                  or the ones after a volume on its level, a chapter's parts
+                  follow it with a higher level
         template_path: Path to nav.xhtml template
-        output_path: Where to save the result
+        output_path: Where to save the result (None to only return it)
         title: Book title to replace $(title)
     """
     # Generate the TOC list
     nav_items = []
+    pages = {id(chapter): name for chapter, _, name in chapter_pages(chapters)}
+    # Chapters whose <li> is still open: [level, whether their sublist is open]
+    open_chapters = []
+
+    def close(level):
+        while open_chapters and open_chapters[-1][0] >= level:
+            _, sublist = open_chapters.pop()
+            if sublist:
+                nav_items.append('</ul>')
+            nav_items.append('</li>')
+
+    def open_sublist():
+        if open_chapters and not open_chapters[-1][1]:
+            nav_items.append('<ul class="toc-sublist">')
+            open_chapters[-1][1] = True
 
     section_num = 0
-    # Add unindented items (prefaces, etc.)
-    if '' in toc_data:
-        for section in toc_data['']:
-            section_num += 1
-            nav_items.append(f'<li class="toc-item"><a href="Section{section_num:03d}.xhtml">{section}</a></li>')
-
-    # Add chapters with subsections
-    for chapter, sections in toc_data.items():
-        if chapter == '':  # Skip the preface key
+    for chapter in chapters:
+        if not chapter.title:
+            # Add unindented items (prefaces, etc.), after a volume they go next to it
+            close(chapter.level)
+            open_sublist()
+            for section in chapter.sections:
+                section_num += 1
+                nav_items.append(f'<li class="toc-item"><a href="Section{section_num:03d}.xhtml">{section.title}</a></li>')
             continue
 
-        nav_items.append(f'<li class="toc-chapter"><a href="Subtitle{section_num+1:03d}.xhtml">{chapter}</a>')
-        if sections:
-            nav_items.append('<ul class="toc-sublist">')
-            for section in sections:
+        # Add chapters with subsections, parts go into the sublist of their chapter
+        close(chapter.level)
+        open_sublist()
+        nav_items.append(f'<li class="toc-chapter"><a href="{pages[id(chapter)]}">{chapter.title}</a>')
+        open_chapters.append([chapter.level, False])
+        if chapter.sections:
+            open_sublist()
+            for section in chapter.sections:
                 section_num += 1
-                nav_items.append(f'<li class="toc-item"><a href="Section{section_num:03d}.xhtml">{section}</a></li>')
-            nav_items.append('</ul>')
-        nav_items.append('</li>')
+                nav_items.append(f'<li class="toc-item"><a href="Section{section_num:03d}.xhtml">{section.title}</a></li>')
+    close(0)
 
     # Join all items with newlines and proper indentation
     navlist = "\n    ".join(nav_items)
 
-    # Read and process template
-    template = Path(template_path).read_text(encoding='utf-8')
-    processed = template.replace('$(title)', title).replace('$(navlist)', navlist)
+    processed = load_template(template_path).render(title=title, navlist=navlist)
 
     # Write output
-    Path(output_path).write_text(processed, encoding='utf-8')
+    if output_path:
+        Path(output_path).write_text(processed, encoding='utf-8')
+    return processed
 
 
 
 def generate_titlepage(template_path, output_path, title, author, date, subtitle=None):
-    template = Path(template_path).read_text(encoding='utf-8')
-    if subtitle:
-        processed = template.replace('$(title)', title).replace('$(author)', author).replace('$(author)', author).replace('$(date)', date).replace('$(subtitle)', subtitle)
-    else:
-        processed = template.replace('$(title)', title).replace('$(author)', author).replace('$(author)', author).replace('$(date)', date).replace('<h2>$(subtitle)</h2>', '')
-    Path(output_path).write_text(processed, encoding='utf-8')
+    template = load_template(template_path)
+    if not subtitle:
+        template = template.without('<h2>$(subtitle)</h2>')
+    processed = template.render(title=title, author=author, date=date, subtitle=subtitle)
+    if output_path:
+        Path(output_path).write_text(processed, encoding='utf-8')
+    return processed
+
+# BeautifulSoup parser backend, "lxml" is a lot faster if it is installed
+PARSER = os.environ.get("EPUBBER_PARSER", "html.parser")
+
+KEEP_ATTRS = {'href', 'id', 'name'}
+KEEP_IMG_ATTRS = {'src', 'alt'}
+DROP_CLASSES = {'footer', 'next', 'updat'}
+BLOCK_TAGS = {'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ul', 'ol', 'li', 'dl', 'dd', 'dt', 'blockquote', 'div',
+              'table', 'tr', 'td', 'th', 'pre', 'hr', 'br'}
+NO_SPACE_BEFORE = '.,;:!?“”'
+NO_SPACE_AFTER = '„('
+WHITESPACE = re.compile(r'\s+')
+SPACE_BEFORE_PUNCTUATION = re.compile(r'\s+([.,;:!?“”])')
+SPACE_AFTER_OPENING = re.compile(r'([„(])\s+')
+
+
+def _is_top_link(p):
+    """The "Anfang der Seite" paragraph linking back to the top of the page"""
+    links = p.find_all('a', recursive=False)
+    return (len(links) == 1 and links[0].get('href') == '#top'
+            and links[0].get_text(strip=True).lower() == 'anfang der seite'
+            and p.get_text(strip=True) == links[0].get_text(strip=True))
+
+
+def _is_empty(tag):
+    """Only whitespace/&nbsp; and no child elements"""
+    return all(isinstance(child, NavigableString) for child in tag.contents) and not tag.get_text().strip()
+
+
+def _is_block(node):
+    """Block level element (or the edge of the parent)"""
+    return node is None or isinstance(node, Tag) and node.name in BLOCK_TAGS
+
+
+def _merge_strings(node):
+    """Merge neighbouring strings (e.g. after unwrapping a link), only direct children"""
+    children = node.contents
+    i = 1
+    while i < len(children):
+        a, b = children[i - 1], children[i]
+        if type(a) is NavigableString and type(b) is NavigableString:
+            merged = NavigableString(a + b)
+            b.extract()
+            a.replace_with(merged)
+        else:
+            i += 1
+
+
+def _normalize_text(node):
+    """Normalize whitespace of the text directly inside node, with a space between text and inline tags"""
+    _merge_strings(node)
+    children = node.contents
+    for i, child in enumerate(children):
+        if not isinstance(child, NavigableString) or isinstance(child, Comment):
+            continue
+        prev = children[i - 1] if i > 0 else None
+        nxt = children[i + 1] if i + 1 < len(children) else None
+        if not child.strip() and _is_block(prev) and _is_block(nxt):
+            # Between blocks only the line break matters
+            if child != '\n':
+                child.replace_with('\n')
+            continue
+        text = WHITESPACE.sub(' ', child)
+        text = SPACE_BEFORE_PUNCTUATION.sub(r'\1', text)
+        text = SPACE_AFTER_OPENING.sub(r'\1', text)
+        if _is_block(prev):
+            text = text.lstrip()
+        elif text[:1].isspace() and text.lstrip()[:1] in tuple(NO_SPACE_BEFORE):
+            text = text.lstrip()
+        elif isinstance(prev, Tag) and text and not text[0].isspace() and text[0] not in NO_SPACE_BEFORE:
+            text = ' ' + text
+        if _is_block(nxt):
+            text = text.rstrip()
+        elif isinstance(nxt, Tag) and text and not text[-1].isspace() and text[-1] not in NO_SPACE_AFTER:
+            text = text + ' '
+        if text != child:
+            child.replace_with(text)
+
+
+def _clean_node(node, state):
+    """Clean the children of node in place (one depth first walk)"""
+    for child in list(node.children):
+        if isinstance(child, Comment):
+            child.extract()
+            continue
+        if not isinstance(child, Tag):
+            continue
+
+        # Footer/navigation paragraphs go entirely
+        if child.name == 'p' and DROP_CLASSES.intersection(child.get('class') or ()):
+            child.decompose()
+            continue
+
+        _clean_node(child, state)
+
+        if child.name == 'a':
+            href = child.get('href', '')
+            # Remove external links and links to other pages or images, keep their text
+            if (href.startswith(('http://', 'https://')) or '.htm' in href.lower()
+                    or href.lower().endswith(IMAGE_SUFFIXES)):
+                child.unwrap()
+                continue
+            if _is_empty(child):
+                child.decompose()
+                continue
+        elif child.name == 'p':
+            if _is_top_link(child):
+                child.decompose()
+                continue
+            state['last_p'] = child
 
-def clean_legacy_html(html_content):
-    """Properly handles anchor tags without duplication"""
-    soup = BeautifulSoup(html_content, 'html.parser')
-
-    # 1. First convert all entities to proper characters
-    entity_map = {
-        '&#8222;': '„',
-        '&#8220;': '“',
-        '&#8211;': '–',
-        '&#223;': 'ß',
-        '&#252;': 'ü',
-        '&#220;': 'Ü',
-        '&#228;': 'ä',
-        '&#196;': 'Ä',
-        '&#246;': 'ö',
-        '&#214;': 'Ö',
-        '&#8230;': '…'
-    }
-
-    # 2. Clean attributes while preserving structure
-    for tag in soup.find_all(True):
         # Remove all attributes except these
-        if hasattr(tag, 'attrs'):
-            attrs_to_keep = {'href', 'id', 'name'}
-            tag.attrs = {k: v for k, v in tag.attrs.items()
-                        if k in attrs_to_keep}
-
-    # 2.3 Remove external links and file links
-    for a in soup.find_all('a', href=True):
-        href = a['href']
-        # Remove if href starts with http or ends with .htm/.html
-        if href.startswith(('http://', 'https://')) or '.htm' in href.lower():
-            a.unwrap()
-
-    # 2.5. Remove <p class="footer"> and <p class="next"> elements entirely
-    for class_name in ['footer', 'next', 'updat', ]:
-        for tag in soup.find_all('p', class_=class_name):
-            tag.decompose()
-
-    # Remove specific "Anfang der Seite" paragraph
-    output = str(soup)
-    output = re.sub(
-        r'<p[^>]*>\s*<a\s[^>]*href="#top"[^>]*>Anfang der Seite</a>\s*</p>',
-        '',
-        output,
-        flags=re.IGNORECASE
-    )
-    soup = BeautifulSoup(output, 'html.parser')
-
-    # 2.6. Remove everything after the last <p> tag
-    all_p = soup.find_all('p')
-    if all_p:
-        last_p = all_p[-1]
-        next_node = last_p.next_sibling
-        while next_node:
-            to_remove = next_node
-            next_node = next_node.next_sibling
-            if hasattr(to_remove, 'decompose'):
-                to_remove.decompose()
-            else:
-                to_remove.extract()
-
-    # 3. Special handling for paragraphs
-    for p in soup.find_all('p'):
-        # Only process paragraphs that actually contain text
-        if p.get_text(strip=True):
-            # Clean up spacing around elements
-            for content in p.contents:
-                if isinstance(content, str):
-                    # Normalize whitespace
-                    new_content = ' '.join(content.split())
-                    content.replace_with(new_content)
-
-    # 4. Convert to string and final cleanup
-    output = str(soup)
-
-    # Replace entities
-    for entity, replacement in entity_map.items():
-        output = output.replace(entity, replacement)
-
-    # Add space before opening tags if missing
-    output = re.sub(r'(?<!\s)(<[^/!][^>]*>)', r' \1', output)
-    # Add space after closing tags if missing
-    output = re.sub(r'(</[^>]+>)(?!\s)', r'\1 ', output)
-    # Clean up any double spaces created
-    output = re.sub(r'  +', ' ', output)
-
-    # Fix common spacing issues
-    output = re.sub(r'\s+([.,;:!?“”])', r'\1', output)  # Remove space before punctuation
-    output = re.sub(r'([„(])\s+', r'\1', output)        # Remove space after opening quotes/parens
-
-    # Ensure anchors stay within paragraphs
-    output = re.sub(r'(</a>)\s*(</p>)', r'\1\2', output)
-    output = re.sub(r'(<p[^>]*>)\s*(<a)', r'\1\2', output)
-    output = output.replace('<br>', '<br/>')
-    output = output.replace('<hr>', '<hr/>')
-    output = re.sub(r'<a[^>]*>\s*(?:&nbsp;|\s)*</a>', '', output)
-    output = re.sub(r'<p[^>]*>\s*(?:&nbsp;|\s)*</p>', '', output)
-
-    return output
-
-
-def reformat(script_dir, input_file):
-    print("Reformatting book...")
+        keep = KEEP_ATTRS | KEEP_IMG_ATTRS if child.name == 'img' else KEEP_ATTRS
+        child.attrs = {k: v for k, v in child.attrs.items() if k in keep}
+        if '\\' in child.attrs.get('href', ''):
+            child['href'] = child['href'].replace('\\', '/')
+
+    _normalize_text(node)
+
+
+def clean_tree(root):
+    """
+    Cleans a parsed section in place: strips attributes, unwraps external and
+    cross page links, drops footers and empty paragraphs, removes everything
+    after the last paragraph and normalizes whitespace. Entities are already
+    decoded by the parser, so serialize the result with formatter="minimal".
+    """
+    state = {'last_p': None}
+    _clean_node(root, state)
+
+    # Remove everything after the last <p> tag
+    last_p = state['last_p']
+    if last_p is not None:
+        for node in list(last_p.next_siblings):
+            node.extract()
+
+    # Empty paragraphs go last, after the last <p> was determined
+    for p in root.find_all('p'):
+        if _is_empty(p):
+            p.decompose()
+    return root
+
+
+def clean_legacy_html(html_content, parser=None):
+    """Properly handles anchor tags without duplication"""
+    soup = BeautifulSoup(html_content, parser or PARSER)
+    root = soup.body or soup
+    clean_tree(root)
+    return root.decode_contents(formatter="minimal")
+
+
+# Worker processes for reformatting sections in parallel
+REFORMAT_WORKERS = int(os.environ.get("EPUBBER_REFORMAT_WORKERS", min(4, os.cpu_count() or 1)))
+# Below this many sections starting worker processes isn't worth it
+PARALLEL_MIN_SECTIONS = 8
+# Sections handed to the pool ahead of the one being packaged, per worker
+WINDOW_PER_WORKER = 2
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def get_pool(workers):
+    """Process pool shared by all builds of this process, so workers are only started once"""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # spawn instead of fork, we are usually running inside a threaded web server
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _pool_workers = workers
+        return _pool
+
+
+def clean_section(i, content, section, parser=None):
+    """
+    Turns the downloaded page of a section into the cleaned body of its page.
+
+    Runs in a worker process, so it only takes and returns plain values:
+    returns (i, body, None, timings) or (i, body, error message, timings)
+    with the seconds spent per step (parse, match, clean). content is None
+    if the page could not be downloaded. A section that fails gets a short
+    placeholder body, so one bad page doesn't take down the book.
+    """
+    timings = {}
+    start = time.perf_counter()
     try:
-        # Read the local file
-        with open(input_file, 'r', encoding='utf-8') as f:
-            content = f.read()
+        if content is None:
+            raise ValueError("page could not be downloaded")
+        soup = BeautifulSoup(content, parser or PARSER)
+        timings['parse'], start = _lap(start)
+        heading = HeadingIndex(soup).match(section)
+        timings['match'], start = _lap(start)
+        if not heading:
+            raise ValueError("no heading found")
+        current_element = heading
+        h1 = soup.new_tag('h1')
+        h1.extend(current_element.contents)
+        current_element.replace_with(h1)
+        current_element = h1
+        # Move everything from the heading to the end marker into its own
+        # container and clean it there, no need to serialize and reparse
+        end = soup.find('p', {'class':'updat'})
+        extracted = []
+        while current_element and current_element != end:
+            extracted.append(current_element)
+            current_element = current_element.next_sibling
+        container = soup.new_tag('div')
+        for node in extracted:
+            container.append(node.extract())
+        clean = clean_tree(container).decode_contents(formatter="minimal")
+        timings['clean'] = _lap(start)[0]
+        error = None
+    except Exception as e:
+        error = str(e) or type(e).__name__
+        clean = f"<h1>{escape(section, False)}</h1>\n<p>This section could not be converted ({escape(error, False)}).</p>"
+    return i, clean, error, timings
+
+
+def _lap(start):
+    now = time.perf_counter()
+    return now - start, now
+
 
-        folder_path = os.path.dirname(input_file)
+def stored_sections(files, count):
+    """(i, html) of the downloaded Source/SectionNNN.html in files, html is None for missing ones"""
+    for i in range(1, count + 1):
+        name = source_name(i)
+        yield i, files.read(name) if files.exists(name) else None
 
-        # Parse with BeautifulSoup
-        soup = BeautifulSoup(content, 'html.parser')
 
-        # Find author and title (always first h2 and h1 of page)
-        page_title = soup.title.string.strip() if soup.title else "Datum unbekannt"
-        if page_title != "Datum unbekannt":
-            date_string = page_title.split("(")[-1]
-            date = date_string.split(")")[0]
+def iter_reformatted(sources, sections, template, workers=None, progress=None, cache=None, images=None):
+    """
+    Reformat the sections (manifest.Section) as their sources (i, html) come
+    in, in a process pool for bigger books.
+
+    Yields (i, page) in reading order, each as soon as it and all sections
+    before it are done. Only a small window of sections is in flight at any
+    time, so memory doesn't grow with the size of the book. Cleaned bodies
+    come from the sharedcache.SharedCache if it has them, the ones cleaned
+    here go into it. Their images are fetched into images (an
+    images.ImageAssets), or left out without it. Failed sections are
+    reported to progress.
+    """
+    progress = progress or Progress()
+    workers = workers or REFORMAT_WORKERS
+    cache = cache or default_cache()
+    template = load_template(template)
+    images = images or ImageAssets(progress=progress)
+    keys = {}
+
+    def jobs():
+        for i, content in sources:
+            section = sections[i - 1]
+            cached = None
+            if content is not None:
+                key = cache.key('section', section.url, f"{PARSER}\0{section.title}\0{content}")
+                body = cache.get(key, progress.stats)
+                if body is not None:
+                    cached = (i, body, None, {})
+                else:
+                    keys[i] = key
+            yield (i, content, section.title, PARSER), cached
+
+    if workers > 1 and len(sections) >= PARALLEL_MIN_SECTIONS:
+        results = windowed(get_pool(workers), jobs(), workers * WINDOW_PER_WORKER)
+    else:
+        results = (cached or clean_section(*job) for job, cached in jobs())
+
+    errors = 0
+    for i, body, error, timings in results:
+        key = keys.pop(i, None)
+        if key and not error:
+            cache.put(key, body)
+        start = time.perf_counter()
+        body = images.rewrite(body, sections[i - 1].url)
+        timings['images'], start = _lap(start)
+        page = template.render(body=body, sectiontitle=sections[i - 1].title)
+        timings['render'] = _lap(start)[0]
+        progress.stats.section(timings, error)
+        if error:
+            errors += 1
+            progress.error(f"Section {i} ({sections[i - 1].title}): {error}", stage='reformat')
+        progress.item('reformat', i, len(sections))
+        yield i, page
+    if errors:
+        progress.message(f"{errors} of {len(sections)} sections could not be converted")
+
+
+def windowed(pool, jobs, window):
+    """
+    Results of clean_section for jobs, in order, with at most window of them
+    submitted ahead. jobs are (arguments, result), a job that already has its
+    result (from the cache) is not submitted.
+    """
+    pending = deque()
+    for job, result in jobs:
+        if result is None:
+            pending.append(pool.submit(clean_section, *job))
         else:
-            date = page_title
-        author = soup.find('h2').text
-        title_elem = soup.find('h1')
-        title = title_elem.text
-        title = title.replace("\n", "")
-        subtitle = None
-        potential_subtitle = title_elem.find_next(['h1', 'h2', 'h3', 'h4'])
-        if potential_subtitle:
-            subtitle = potential_subtitle.text
-            if  german_fuzzy_match(subtitle, date, 50):
-                subtitle = None
-        output_path = Path(os.path.join(folder_path, "titlepage.xhtml"))
-        template_path = Path(os.path.join(script_dir, "..", "templates", "titlepage.xhtml"))
-        template = template_path.read_text(encoding='utf-8')
-        generate_titlepage(template_path, output_path, title, author, date, subtitle)
-
-        # Find all links between the markers
-        start_marker = soup.select_one('p.info, p.information, p.fst')
-        end_marker = soup.find('p', {'class': 'updat'})
-        # Collect all unique links between these markers
-        nav_dict = {}
-        counter = 0
-        current_subtitle = ""
-        nav_dict[current_subtitle] = []
-        current_element = start_marker.find_next() if start_marker else None
-        while current_element and current_element != end_marker:
-            if current_element.name == 'a' and current_element.get('href'):
-                href = current_element['href']
-                # Skip anchor links and non-HTML files
-                if not href.startswith('#') and not href.startswith('mailto:') and not href.startswith('http') and not href.startswith('..') and not href.endswith(('.pdf', '.jpg', '.png', 'index.htm', 'index.html')) and not 'translator.htm' in href and not "#" in href.split(".")[-1]:
-                    nav_dict[current_subtitle].append(current_element.text)
-                    counter += 1
-            elif current_element.name in ['h1', 'h2', 'h3', 'h4'] and not current_element.text.lower().startswith("content"):
-                num = counter+1
-                subtitle_filename = f"Subtitle{num:03d}.xhtml"
-                subtitle_path = Path(os.path.join(folder_path, subtitle_filename))
-                template_path = Path(os.path.join(script_dir, "..", "templates", "SubtitleXXX.xhtml"))
-                template = template_path.read_text(encoding='utf-8')
-                updated_content = template.replace("$(title)", current_element.text)
-                subtitle_path.write_text(updated_content, encoding='utf-8')
-                current_subtitle = current_element.text
-                nav_dict[current_subtitle] = []
-
-            current_element = current_element.find_next()
-        template_path = Path(os.path.join(script_dir, "..", "templates", "nav.xhtml"))
-        nav_path = Path(os.path.join(folder_path, "nav.xhtml"))
-        generate_epub_toc(nav_dict, template_path, nav_path, title)
-
-        # Next, edit the section files to be readable...
-        sections = []
-        for secs in nav_dict.values():
-            sections.extend(secs)
-        for i, section in enumerate(sections, 1):
-            section_file = Path(os.path.join(folder_path, f"Section{i:03d}.xhtml"))
-            content = section_file.read_text(encoding='utf-8')
-            soup = BeautifulSoup(content, 'html.parser')
-            current_element = soup.find('body')
-            found_title = False
-            search_words = set(section.lower().split())
-            for heading in soup.find_all(['h1', 'h2', 'h3', 'h4']):
-                heading_text = heading.get_text(' ', strip=True).lower()
-                if german_fuzzy_match(section, heading_text):
-                    found_title = True
-                    break
-                heading_words = set(heading_text.split())
-                common_words = search_words & heading_words
-                if len(common_words) >= max(1, 0.8*len(search_words)) or len(common_words) >= max(1, 0.8*len(heading_words)): # at least 80% words matching
-                    found_title = True
-                    break
-            if not heading:
-                break
-            current_element = heading
-            h1 = soup.new_tag('h1')
-            h1.extend(current_element.contents)
-            current_element.replace_with(h1)
-            current_element = h1
-            extracted = []
-            end = soup.find('p', {'class':'updat'})
-            while current_element and current_element != end:
-                extracted.append(str(current_element))
-                current_element = current_element.next_sibling
-            dirty = '\n'.join(extracted)
-            clean = clean_legacy_html(dirty)
-            template_path = Path(os.path.join(script_dir, "..", "templates", "SectionXXX.xhtml"))
-            template = template_path.read_text(encoding='utf-8')
-            template = template.replace("$(body)", clean)
-            template = template.replace("$(sectiontitle)", section)
-            section_file.write_text(template, encoding='utf-8')
-
-        # next, just fill out the content.opf and move everything into the required structure (if required i guess)
-        template_path = Path(os.path.join(script_dir, "..", "templates", "content.opf"))
-        template = template_path.read_text(encoding="utf-8")
-        template = template.replace("$(title)", title)
-        template = template.replace("$(author)", author)
-
-        manifest = []
-        spine = []
-        for i in range(1, len(sections)+1):
-            if f"Subtitle{i:03d}.xhtml" in os.listdir(folder_path):
-                mani = f'    <item id="Subtitle{i:03d}.xhtml" href="Text/Subtitle{i:03d}.xhtml" media-type="application/xhtml+xml"/>'
-                spi = f'    <itemref idref="Subtitle{i:03d}.xhtml"/>'
-                manifest.append(mani)
-                spine.append(spi)
-
-            mani = f'    <item id="Section{i:03d}.xhtml" href="Text/Section{i:03d}.xhtml" media-type="application/xhtml+xml"/>'
-            spi = f'    <itemref idref="Section{i:03d}.xhtml"/>'
-            manifest.append(mani)
-            spine.append(spi)
-        manifest_text = "\n".join(m for m in manifest)
-        spine_text = "\n".join(s for s in spine)
-        template = template.replace("$(manifest)", manifest_text)
-        template = template.replace("$(spine)", spine_text)
-        out = Path(os.path.join(script_dir, "..", "content.opf"))
-        out.write_text(template, encoding='utf-8')
-
-        os.remove(input_file)
-        print("Finished reformatting")
+            pending.append(Future())
+            pending[-1].set_result(result)
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def chapter_pages(chapters):
+    """
+    (chapter, number, page name) of the chapters with a title, in order.
+    Their Subtitle pages are numbered like the first section of the chapter,
+    a volume and its first part start at the same section, the later ones
+    get a suffix (Subtitle005.xhtml, Subtitle005-2.xhtml).
+    """
+    counter = 0
+    used = {}
+    for chapter in chapters:
+        if chapter.title:
+            number = counter + 1
+            used[number] = used.get(number, 0) + 1
+            suffix = f"-{used[number]}" if used[number] > 1 else ""
+            yield chapter, number, f"Subtitle{number:03d}{suffix}.xhtml"
+        counter += len(chapter.sections)
+
+
+def subtitle_pages(manifest):
+    """{number: [(page name, chapter title)]} of the Subtitle pages, see chapter_pages"""
+    subtitles = {}
+    for chapter, number, name in chapter_pages(manifest.chapters):
+        subtitles.setdefault(number, []).append((name, chapter.title))
+    return subtitles
+
+
+def reading_order(count, subtitles):
+    """File names of the Subtitle and Section pages in reading order, for the manifest and spine"""
+    for i in range(1, count + 1):
+        for name, _ in subtitles.get(i, ()):
+            yield name
+        yield f"Section{i:03d}.xhtml"
+    for i in sorted(subtitles):
+        if i > count:
+            for name, _ in subtitles[i]:
+                yield name
+
+
+# Last page of a book whose sections could not all be downloaded
+MISSING_PAGE = "Missing.xhtml"
+
+
+def iter_book_pages(script_dir, manifest, sources, workers=None, progress=None, fetcher=None):
+    """
+    Yields (name, text or data) for every generated file of the book:
+    titlepage and nav first, then the Subtitle and Section pages in reading
+    order, each as soon as it is ready and followed by the images it brings
+    into the book, a page listing the sections that could not be downloaded
+    (if any) and content.opf last.
+
+    sources yields the downloaded (i, html) of the sections in reading order,
+    see stored_sections and downloader.iter_sections. Images are fetched with
+    fetcher, without one they are left out.
+    """
+    progress = progress or Progress()
+    title = manifest.title
+    author = manifest.author
+    sections = manifest.sections()
+    subtitles = subtitle_pages(manifest)
+    template_dir = Path(script_dir, "..", "templates")
+    images = ImageAssets(fetcher, progress=progress)
+
+    yield "Text/titlepage.xhtml", generate_titlepage(template_dir / "titlepage.xhtml", None, title, author,
+                                                     manifest.date, manifest.subtitle)
+    yield "Text/nav.xhtml", generate_epub_toc(manifest.chapters, template_dir / "nav.xhtml", None, title)
+
+    # Next, edit the section files to be readable, with the Subtitle page of
+    # a chapter right before its first section
+    subtitle_template = load_template(template_dir / "SubtitleXXX.xhtml")
+    section_template = str(template_dir / "SectionXXX.xhtml")
+    missing = []
+
+    def tracked(sources):
+        for i, html in sources:
+            if html is None:
+                missing.append(i)
+            yield i, html
+
+    for i, page in iter_reformatted(tracked(sources), sections, section_template, workers, progress, images=images):
+        for name, subtitle in subtitles.get(i, ()):
+            yield f"Text/{name}", subtitle_template.render(title=subtitle)
+        yield f"Text/Section{i:03d}.xhtml", page
+        for name, data in images.take():
+            yield f"Images/{name}", data
+    # Chapters without sections at the very end
+    for i in sorted(subtitles):
+        if i > len(sections):
+            for name, subtitle in subtitles[i]:
+                yield f"Text/{name}", subtitle_template.render(title=subtitle)
+    if images.dropped:
+        progress.message(f"{images.dropped} images left out, the book's image budget is used up")
+    # A streamed book is on its way to the reader already, this is where they learn about the gaps
+    if missing:
+        titles = "\n".join(f"<li>{escape(sections[i - 1].title, False)}</li>" for i in missing)
+        body = (f"<h1>Incomplete book</h1>\n<p>These sections could not be downloaded, "
+                f"building the book again later may bring them in:</p>\n<ul>\n{titles}\n</ul>")
+        yield f"Text/{MISSING_PAGE}", load_template(section_template).render(body=body, sectiontitle="Incomplete book")
+
+    # content.opf lives next to Text/, it goes last as it lists the images
+    items = []
+    spine = []
+    for name in list(reading_order(len(sections), subtitles)) + ([MISSING_PAGE] if missing else []):
+        items.append(f'    <item id="{name}" href="Text/{name}" media-type="application/xhtml+xml"/>')
+        spine.append(f'    <itemref idref="{name}"/>')
+    items += images.manifest_items()
+    yield "content.opf", load_template(template_dir / "content.opf").render(
+        title=title, author=author, manifest="\n".join(items), spine="\n".join(spine))
+
+
+def reformat(script_dir, manifest, files, progress=None, workers=None, fetcher=None):
+    """
+    Turn the downloaded sections in Source/ into the pages of the book
+    described by manifest, in Text/, and their images, in Images/.
+
+    files is the build folder or a bookfiles.MemoryFiles.
+    """
+    progress = progress or Progress()
+    files = as_files(files)
+    progress.stage('reformat', "Reformatting book...")
+    try:
+        # Pages of an earlier build (which may have had more sections) go
+        files.clear("Text/")
+        files.clear("Images/")
+        sources = stored_sections(files, len(manifest.sections()))
+        for name, text in iter_book_pages(script_dir, manifest, sources, workers, progress, fetcher):
+            files.write(name, text)
+        progress.message("Finished reformatting")
 
     except Exception as e:
-        print(f"Error processing file: {str(e)}")
-        sys.exit(1)
+        progress.error(f"Error processing file: {str(e)}", stage='reformat')
+        raise
 
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: python process_local.py <input_file.html>")
+        print("Usage: python process_local.py <Source/index.html>")
         sys.exit(1)
 
     script_dir = Path(__file__).parent.resolve()
     input_file = sys.argv[1]
-    reformat(script_dir, input_file)
+    manifest = extract_manifest(Path(input_file).read_text(encoding='utf-8'), None)
+    try:
+        reformat(script_dir, manifest, os.path.dirname(os.path.dirname(os.path.abspath(input_file))))
+    except Exception:
+        sys.exit(1)
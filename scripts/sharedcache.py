@@ -0,0 +1,174 @@
+import os
+import time
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+from buildcache import PIPELINE_VERSION
+from metrics import SHARED_CACHE
+
+DEFAULT_LOCAL_MB = float(os.environ.get("EPUBBER_LOCAL_CACHE_MB", 64))
+DEFAULT_SHARED_MB = float(os.environ.get("EPUBBER_SHARED_CACHE_MB", 256))
+# Entries nobody asked for in this long go, even below the memory budget
+DEFAULT_TTL = 30 * 24 * 3600
+# Entries dropped at once when the shared cache is over its budget
+EVICT_BATCH = 32
+
+
+class LocalCache:
+    """In-process LRU of compressed values, capped at max_bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, dropped = self.entries.popitem(last=False)
+                self.size -= len(dropped)
+
+
+class SharedCache:
+    """
+    Cache of what the pipeline derives from a page (cleaned section bodies,
+    book manifests), shared by all web nodes through Redis, with a local LRU
+    in front of it.
+
+    Keys cover the page URL, a hash of its source and the pipeline version,
+    so an entry never outlives the page or the code it was made from. Values
+    are zlib compressed on both levels. Redis holds at most `shared_mb` of
+    them, least recently used entries are evicted first, the size is tracked
+    in Redis itself so every node sees the same total. Without a redis
+    client only the local level is used. Redis errors count as misses, the
+    cache never fails a build.
+    """
+
+    def __init__(self, redis_client=None, local_mb=DEFAULT_LOCAL_MB, shared_mb=DEFAULT_SHARED_MB, ttl=DEFAULT_TTL,
+                 prefix="epubber"):
+        self.redis = redis_client
+        self.local = LocalCache(int(local_mb * 1024**2))
+        self.max_shared = int(shared_mb * 1024**2)
+        self.ttl = ttl
+        self.prefix = f"{prefix}:derived"
+        self.index_key = f"{self.prefix}:lru"
+        self.sizes_key = f"{self.prefix}:sizes"
+        self.total_key = f"{self.prefix}:bytes"
+
+    @staticmethod
+    def key(kind, url, source):
+        """Key of what `kind` makes from the page at url with this source text"""
+        digest = hashlib.sha256(f"{PIPELINE_VERSION}\0{kind}\0{url}\0".encode('utf-8'))
+        digest.update(source.encode('utf-8'))
+        return f"{kind}:{digest.hexdigest()}"
+
+    def _redis_key(self, key):
+        return f"{self.prefix}:{key}"
+
+    def get(self, key, stats=None):
+        """The cached text for key, or None"""
+        kind = key.split(':', 1)[0]
+        data = self.local.get(key)
+        result = 'local'
+        if data is None:
+            data, result = self._get_shared(key)
+            if data is not None:
+                self.local.put(key, data)
+        SHARED_CACHE.inc(kind=kind, result=result)
+        if stats is not None:
+            stats.add(f"{kind}_cache_{result}")
+        return zlib.decompress(data).decode('utf-8') if data is not None else None
+
+    def _get_shared(self, key):
+        if self.redis is None:
+            return None, 'miss'
+        redis_key = self._redis_key(key)
+        try:
+            data = self.redis.get(redis_key)
+            if data is None:
+                return None, 'miss'
+            with self.redis.pipeline(transaction=False) as pipe:
+                pipe.zadd(self.index_key, {redis_key: time.time()})
+                pipe.expire(redis_key, self.ttl)
+                pipe.execute()
+            return data, 'shared'
+        except Exception:
+            return None, 'error'
+
+    def put(self, key, text):
+        data = zlib.compress(text.encode('utf-8'))
+        self.local.put(key, data)
+        if self.redis is None:
+            return
+        redis_key = self._redis_key(key)
+        try:
+            # Another node may have stored it meanwhile, count its size only once
+            if not self.redis.set(redis_key, data, nx=True, ex=self.ttl):
+                return
+            with self.redis.pipeline(transaction=False) as pipe:
+                pipe.zadd(self.index_key, {redis_key: time.time()})
+                pipe.hset(self.sizes_key, redis_key, len(data))
+                pipe.incrby(self.total_key, len(data))
+                total = pipe.execute()[-1]
+            if total > self.max_shared:
+                self._evict()
+        except Exception:
+            SHARED_CACHE.inc(kind=key.split(':', 1)[0], result='error')
+
+    def _evict(self):
+        """Drop least recently used entries until the shared level is within its budget"""
+        while int(self.redis.get(self.total_key) or 0) > self.max_shared:
+            oldest = [member for member, _ in self.redis.zpopmin(self.index_key, EVICT_BATCH)]
+            if not oldest:
+                # The index got lost (e.g. a flush), start counting again
+                self.redis.set(self.total_key, 0)
+                return
+            sizes = self.redis.hmget(self.sizes_key, oldest)
+            with self.redis.pipeline(transaction=False) as pipe:
+                pipe.delete(*oldest)
+                pipe.hdel(self.sizes_key, *oldest)
+                pipe.decrby(self.total_key, sum(int(size or 0) for size in sizes))
+                pipe.execute()
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_cache():
+    """
+    The cache builds use unless they are given one: local only, or shared
+    through the Redis at EPUBBER_REDIS_URL if that is set. The web app sets
+    its own with set_default_cache().
+    """
+    global _default
+    with _default_lock:
+        if _default is None:
+            redis_client = None
+            if os.environ.get("EPUBBER_REDIS_URL"):
+                import redis
+                redis_client = redis.Redis.from_url(os.environ["EPUBBER_REDIS_URL"])
+            _default = SharedCache(redis_client)
+        return _default
+
+
+def set_default_cache(cache):
+    global _default
+    with _default_lock:
+        _default = cache
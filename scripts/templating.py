@@ -0,0 +1,53 @@
+import re
+from functools import lru_cache
+from pathlib import Path
+
+TEMPLATE_DIR = Path(__file__).parent.parent.resolve() / "templates"
+
+PLACEHOLDER = re.compile(r'\$\((\w+)\)')
+
+
+class Template:
+    """
+    A template split once into its literal text and $(name) placeholders.
+
+    render() fills in all placeholders in a single pass, so values are never
+    searched for placeholders themselves. Placeholders without a value are
+    left as they are.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        parts = PLACEHOLDER.split(text)
+        self.literals = parts[0::2]
+        self.names = parts[1::2]
+
+    def render(self, **values):
+        out = [self.literals[0]]
+        for name, literal in zip(self.names, self.literals[1:]):
+            value = values.get(name)
+            out.append(f"$({name})" if value is None else value)
+            out.append(literal)
+        return "".join(out)
+
+    def without(self, fragment):
+        """The same template with fragment (e.g. an element of an optional placeholder) taken out"""
+        return compile_template(self.text.replace(fragment, ''))
+
+
+@lru_cache(maxsize=64)
+def compile_template(text):
+    return Template(text)
+
+
+@lru_cache(maxsize=64)
+def _load(path):
+    return compile_template(Path(path).read_text(encoding='utf-8'))
+
+
+def load_template(name_or_path):
+    """Compiled template by file name in templates/ (or by path), read from disk once per process"""
+    path = Path(name_or_path)
+    if not path.is_absolute() and path.parent == Path('.'):
+        path = TEMPLATE_DIR / path
+    return _load(str(path.resolve()))
@@ -1,13 +1,21 @@
-from flask import Flask, request, render_template, send_file, Response
-import time
-import sys
+from flask import Flask, request, render_template, send_file, Response, jsonify
+import json
 import os
+import uuid
+import threading
 from pathlib import Path
-from io import StringIO
-from threading import Thread
-from queue import Queue
-
-from processer import from_url  # Import your existing function
+from urllib.parse import quote
+from werkzeug.wsgi import ClosingIterator
+
+from processer import from_url, cached_build, stream_from_url  # Import your existing function
+from jobs import JobQueue, QueueFull, JOB_TIMEOUT
+from progress import LocalEvents, RedisEvents, LogProgress
+from library import Library
+from zipwriter import PROFILES
+from sharedcache import SharedCache, set_default_cache
+from fetcher import share_budgets
+from prebuild import Popularity, Prebuilder, prebuild
+import metrics
 
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
@@ -19,19 +27,49 @@ app = Flask(__name__, template_folder=os.path.join(root_path, 'webinterface'), s
 redis_client = redis.Redis(host='localhost', port=6379, db=0)
 limiter = Limiter(app=app, key_func=get_remote_address, storage_uri="redis://localhost:6379",default_limits=["200 per day", "50 per hour"])
 
-# Queue to hold our output
-output_queue = Queue()
-
-# Custom stdout class to capture prints
-class OutputCapturer:
-    def __init__(self, queue):
-        self.queue = queue
-
-    def write(self, text):
-        self.queue.put(text+"<br>")
-
-    def flush(self):
-        pass
+# Progress events of every job, over redis pub/sub so any worker process can
+# stream any job. EPUBBER_EVENTS=local keeps them in process (single worker only).
+if os.environ.get("EPUBBER_EVENTS", "redis") == "local":
+    events = LocalEvents()
+else:
+    events = RedisEvents(redis_client)
+
+# Cleaned sections and manifests are shared with the other web nodes through
+# redis, EPUBBER_SHARED_CACHE=local keeps them in this process only.
+if os.environ.get("EPUBBER_SHARED_CACHE", "redis") == "local":
+    set_default_cache(SharedCache())
+else:
+    set_default_cache(SharedCache(redis_client))
+
+# Requests to marxists.org are spaced across all worker processes and nodes
+share_budgets(redis_client)
+
+# Bounded pool of build workers per process, fed from a queue in redis
+job_queue = JobQueue(redis_client, from_url, events,
+                     workers=int(os.environ.get("EPUBBER_WORKERS", 2)),
+                     max_queued=int(os.environ.get("EPUBBER_MAX_QUEUED", 20)))
+job_queue.start()
+
+metrics.Gauge("epubber_queue_depth", "Builds waiting in the queue", callback=job_queue.depth)
+
+# Streamed builds run in the request thread, outside the queue, so they have
+# their own limit per process. They take the queue's in-flight marker of the
+# book all the same, so a book is never built twice at once.
+stream_slots = threading.BoundedSemaphore(int(os.environ.get("EPUBBER_STREAMS", 2)))
+
+# Download statistics of the books in files/, decide which ones get evicted first
+library = Library(root_path)
+
+# Requested books are counted, the most popular ones are kept built during
+# off-peak hours (one node at a time), EPUBBER_PREBUILD=off turns that off
+popularity = Popularity(redis_client)
+if os.environ.get("EPUBBER_PREBUILD", "on") != "off":
+    prebuilder = Prebuilder(redis_client, popularity, prebuild, job_queue, root_path,
+                            busy=lambda: job_queue.depth() > 0)
+    prebuilder.start()
+
+def sse(event):
+    return f"data: {json.dumps(event)}\n\n"
 
 @app.route('/', methods=['GET', 'POST'])
 @limiter.limit("10 per minute")  # Specific limit for index page
@@ -47,44 +85,91 @@ def index():
 @app.route('/process/<path:url>')
 @limiter.limit("5 per minute")
 def process(url):
+    popularity.record(url)
+    # Book was built recently, no need to run the pipeline at all
+    file_path = cached_build(url)
+    if file_path:
+        return Response(sse({'type': 'done', 'result': str(file_path)}), mimetype='text/event-stream')
+
+    try:
+        job_id = job_queue.submit(url)
+    except QueueFull as e:
+        return Response(sse({'type': 'failed', 'error': str(e)}), mimetype='text/event-stream')
+
+    # ?timings=1 keeps the timing summary of the build in the final event
+    timings = request.args.get('timings') == '1'
+
     def generate():
-        # Redirect stdout to our capturer
-        sys.stdout = OutputCapturer(output_queue)
-
-        # Run processing in a thread
-        def process_task():
-            try:
-                file_path = from_url(url)
-                output_queue.put(f"FILE_READY:{file_path}")
-            except Exception as e:
-                output_queue.put(f"ERROR:{str(e)}")
-
-        Thread(target=process_task).start()
-
-        # Stream output to client
-        while True:
-            output = output_queue.get()
-            if output.startswith("FILE_READY:"):
-                file_path = output.split(":")[1]
-                yield f"data: {output}\n\n"
-                break
-            elif output.startswith("ERROR:"):
-                yield f"data: {output}\n\n"
-                break
-            else:
-                yield f"data: {output}\n\n"
+        yield sse({'type': 'job', 'job_id': job_id})
+        # Stream the job's progress events until it is finished
+        final = False
+        for event in events.subscribe(job_id, idle_timeout=JOB_TIMEOUT):
+            final = event['type'] in ('done', 'failed')
+            if not timings:
+                event.pop('timings', None)
+            yield sse(event)
+        if not final:
+            yield sse({'type': 'failed', 'error': 'Job got lost'})
 
     return Response(generate(), mimetype='text/event-stream')
 
+@app.route('/stream/<path:url>')
+@limiter.limit("5 per minute")
+def stream(url):
+    """Download the book while it is being built, instead of /process followed by /download"""
+    popularity.record(url)
+    file_path = cached_build(url)
+    if file_path:
+        library.touch(file_path)
+        return send_file(root_path / file_path, as_attachment=True, download_name=file_path.name)
+
+    profile = request.args.get('profile')
+    if profile and profile not in PROFILES:
+        return jsonify({'error': f"Unknown profile, use one of {', '.join(PROFILES)}"}), 400
+    if not stream_slots.acquire(blocking=False):
+        return jsonify({'error': "Too many books are being built right now, please try again in a few minutes"}), \
+            503, {'Retry-After': '60'}
+    owner = f"stream:{uuid.uuid4().hex}"
+    if not job_queue.claim(url, owner):
+        stream_slots.release()
+        return jsonify({'error': "This book is being built right now, please try again in a minute"}), \
+            503, {'Retry-After': '60'}
+
+    def done():
+        job_queue.release(url, owner)
+        stream_slots.release()
+
+    try:
+        filename, chunks = stream_from_url(url, LogProgress(), profile=profile)
+    except Exception:
+        done()
+        raise
+    # The slot and the marker are given back once the response is closed, also when the client went away
+    return Response(ClosingIterator(chunks, done), mimetype='application/epub+zip',
+                    headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(filename)}"})
+
+@app.route('/job/<job_id>')
+def job_status(job_id):
+    job = job_queue.status(job_id)
+    if not job:
+        return jsonify({'error': 'unknown job'}), 404
+    return jsonify(job)
+
 @app.route('/download/<path:file_path>')
 @limiter.limit("20 per hour")
 def download(file_path):
+    library.touch(file_path)
     return send_file(
         os.path.join("..", file_path),
         as_attachment=True,
         download_name=os.path.basename(file_path)
     )
 
+@app.route('/metrics')
+@limiter.exempt
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.after_request
 def add_security_headers(response):
     response.headers['X-Content-Type-Options'] = 'nosniff'
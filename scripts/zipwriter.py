@@ -0,0 +1,126 @@
+import os
+import time
+import zlib
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Compression level per profile, "fast" for books that are built on demand
+# and thrown away soon, "small" for ones that are kept and downloaded a lot
+PROFILES = {'fast': 1, 'balanced': 6, 'small': 9}
+DEFAULT_PROFILE = os.environ.get("EPUBBER_ZIP_PROFILE", "balanced")
+# Threads deflating entries, zlib releases the GIL while it works
+ZIP_WORKERS = int(os.environ.get("EPUBBER_ZIP_WORKERS", min(4, os.cpu_count() or 1)))
+# Entries compressed ahead of the one being written, per worker
+WINDOW_PER_WORKER = 2
+
+STORED = 0
+DEFLATED = 8
+# Already compressed, deflating them again only costs time
+STORED_SUFFIXES = ('.jpg', '.jpeg', '.png', '.gif')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Thread pool shared by all builds of this process"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=ZIP_WORKERS, thread_name_prefix="zip")
+        return _pool
+
+
+def compression_level(profile=None):
+    profile = profile or DEFAULT_PROFILE
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown compression profile {profile}, use one of {', '.join(PROFILES)}")
+    return PROFILES[profile]
+
+
+class Entry:
+    """A zip entry whose data is already compressed (or stored), ready to be written"""
+
+    def __init__(self, name, data, crc, size, method, seconds=0.0):
+        self.name = name
+        self.data = data
+        self.crc = crc
+        self.size = size
+        self.method = method
+        # Time it took to compress
+        self.seconds = seconds
+
+
+def compress(name, data, level, method=DEFLATED):
+    """Entry for name with data (bytes or str) as a raw deflate stream, or stored"""
+    start = time.perf_counter()
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    crc = zlib.crc32(data)
+    if method == STORED:
+        return Entry(name, data, crc, len(data), STORED)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    return Entry(name, compressed, crc, len(data), DEFLATED, time.perf_counter() - start)
+
+
+def compress_all(items, level, workers=None):
+    """
+    Entries for (name, data) items, in order, deflated in the thread pool with
+    only a small window of them in flight. Images are stored as they are.
+    """
+    window = (workers or ZIP_WORKERS) * WINDOW_PER_WORKER
+    pool = get_pool()
+    pending = deque()
+    for name, data in items:
+        method = STORED if name.lower().endswith(STORED_SUFFIXES) else DEFLATED
+        pending.append(pool.submit(compress, name, data, level, method))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _dos_time(timestamp):
+    t = time.localtime(timestamp)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class ZipWriter:
+    """
+    Writes a zip from ready Entries: add() returns the bytes of one entry
+    (local header and data), finish() the central directory. As the sizes
+    are known before the header is written, the output is never seeked and
+    needs no data descriptors, so it can go straight into a response.
+    """
+
+    def __init__(self, timestamp=None):
+        self.offset = 0
+        self.records = []
+        self.dos_time, self.dos_date = _dos_time(timestamp or time.time())
+
+    def add(self, entry):
+        name = entry.name.encode('utf-8')
+        flags = 0x800 if not entry.name.isascii() else 0
+        header = struct.pack("<4s5H3L2H", b"PK\x03\x04", 20, flags, entry.method, self.dos_time, self.dos_date,
+                             entry.crc, len(entry.data), entry.size, len(name), 0)
+        # Only what the central directory needs, the data is gone once it is written
+        self.records.append((name, flags, entry.method, entry.crc, len(entry.data), entry.size, self.offset))
+        self.offset += len(header) + len(name) + len(entry.data)
+        return header + name + entry.data
+
+    def finish(self):
+        if len(self.records) > 0xffff or self.offset > 0xffffffff:
+            raise ValueError("Book too big for a zip without zip64")
+        directory = []
+        for name, flags, method, crc, compressed_size, size, offset in self.records:
+            directory.append(struct.pack("<4s6H3L5H2L", b"PK\x01\x02", (3 << 8) | 20, 20, flags, method,
+                                         self.dos_time, self.dos_date, crc, compressed_size, size,
+                                         len(name), 0, 0, 0, 0, 0o100644 << 16, offset))
+            directory.append(name)
+        directory = b"".join(directory)
+        end = struct.pack("<4s4H2LH", b"PK\x05\x06", 0, 0, len(self.records), len(self.records),
+                          len(directory), self.offset, 0)
+        return directory + end
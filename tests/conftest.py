@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The modules live flat in scripts/ and import each other by name
+sys.path.insert(0, str(Path(__file__).parent.parent / "scripts"))
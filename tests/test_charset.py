@@ -0,0 +1,32 @@
+from charset import decode_html
+from reformat import clean_legacy_html
+
+
+def test_backslash_closing_tag():
+    assert decode_html(b"<html><body><P>a<\\P></body></html>") == "<html><body><P>a</P></body></html>"
+
+
+def test_backslash_void_tags():
+    html = decode_html(b"<html><body><p>a<br\\>b<hr\\>c</p></body></html>")
+    assert "<br/>" in html and "<hr/>" in html
+    cleaned = clean_legacy_html(html)
+    assert "\\" not in cleaned
+    assert "</br" not in cleaned and "</hr" not in cleaned
+
+
+def test_meta_charset():
+    data = '<html><head><meta http-equiv="Content-Type" content="text/html; charset=iso-8859-1"></head>' \
+           '<body><p>Gr\xfc\xdfe „Zitat“</p></body></html>'.encode('cp1252')
+    assert "Grüße „Zitat“" in decode_html(data, url="http://example.org/meta/a.htm")
+
+
+def test_bom():
+    text = "<html><body><p>Grüße</p></body></html>"
+    assert decode_html(b"\xef\xbb\xbf" + text.encode('utf-8'), url="http://example.org/bom/a.htm").endswith(text)
+    assert decode_html(b"\xff\xfe" + text.encode('utf-16-le'), url="http://example.org/bom/b.htm").endswith(text)
+
+
+def test_backslash_tags_in_utf16():
+    text = "<html><body><p>a<br\\>b</p></body></html>"
+    assert decode_html(b"\xff\xfe" + text.encode('utf-16-le'), url="http://example.org/bom/c.htm").endswith(
+        "<p>a<br/>b</p></body></html>")
@@ -0,0 +1,12 @@
+from images import ImageAssets
+
+
+def test_dropped_images_leave_no_empty_paragraphs():
+    body = ('<p><img src="a.png"/></p>\n<p>Text <img src="b.png"/> more</p>\n'
+            '<div class="c"><p><a href="x"><img src="c.gif"/></a>&nbsp;</p></div>\n'
+            '<p><a id="fig1"><img src="d.png"/></a></p>')
+    rewritten = ImageAssets(budget_mb=0).rewrite(body, 'http://host/book/index.htm')
+    assert '<img' not in rewritten and '\x00' not in rewritten
+    assert '<p>Text  more</p>' in rewritten
+    assert '<div' not in rewritten and '<a href' not in rewritten
+    assert '<a id="fig1"></a>' in rewritten
@@ -0,0 +1,86 @@
+import fakeredis
+import pytest
+
+from jobs import JobQueue, QueueFull
+from progress import LocalEvents
+
+URL = "http://www.marxists.org/deutsch/archiv/marx-engels/1848/manifest/index.htm"
+
+
+@pytest.fixture
+def built():
+    return []
+
+
+@pytest.fixture
+def queue(built):
+    def build(url, progress):
+        built.append(url)
+        return f"files/{len(built)}.epub"
+
+    return JobQueue(fakeredis.FakeStrictRedis(), build, LocalEvents(), max_queued=2)
+
+
+def run_next(queue):
+    """What a worker does with the next job in the queue"""
+    job_id = queue.redis.rpop(queue.queue_key)
+    assert job_id is not None
+    queue._run(job_id.decode())
+
+
+def test_same_book_is_queued_once(queue):
+    job_id = queue.submit(URL)
+    assert queue.submit(URL) == job_id
+    assert queue.submit(URL.replace("http://", "https://").replace("index.htm", "")) == job_id
+    assert queue.depth() == 1
+    assert queue.status(job_id)['status'] == 'queued'
+
+
+def test_queue_full(queue):
+    queue.submit(URL)
+    queue.submit(URL.replace("manifest", "kapital"))
+    with pytest.raises(QueueFull):
+        queue.submit(URL.replace("manifest", "lohnarbeit"))
+    assert queue.redis.get(queue._inflight_key(URL.replace("manifest", "lohnarbeit"))) is None
+
+
+def test_finished_job_is_not_reused(queue, built):
+    job_id = queue.submit(URL)
+    run_next(queue)
+    assert queue.status(job_id)['status'] == 'done'
+    assert queue.redis.get(queue._inflight_key(URL)) is None
+    assert queue.submit(URL) != job_id
+
+
+def test_stale_marker_is_taken_over(queue, built):
+    queue.redis.set(queue._inflight_key(URL), "0123456789abcdef")
+    job_id = queue.submit(URL)
+    assert job_id != "0123456789abcdef"
+    run_next(queue)
+    assert built == [URL] and queue.status(job_id)['status'] == 'done'
+
+
+def test_job_waits_for_claimed_build(queue, built):
+    assert queue.claim(URL, "prebuild:1")
+    assert not queue.claim(URL, "stream:2")
+    job_id = queue.submit(URL)
+    assert queue.submit(URL) == job_id
+    assert queue.status(job_id)['waiting'] == '1'
+    # Waiting in the delayed set, not in the queue where it would hold a worker
+    assert queue.redis.llen(queue.queue_key) == 0 and queue.depth() == 1
+
+    # Looking again before the claimed build is done puts it back
+    assert not queue._take_over(job_id, URL)
+    assert queue.redis.zscore(queue.delayed_key, job_id) is not None
+
+    # Only the owner releases the claim, which queues the waiting job
+    queue.release(URL, "stream:2")
+    assert queue.redis.llen(queue.queue_key) == 0
+    queue.release(URL, "prebuild:1")
+    assert queue.redis.llen(queue.queue_key) == 1 and queue.redis.zcard(queue.delayed_key) == 0
+
+    run_next(queue)
+    assert built == [URL]
+    assert queue.status(job_id)['status'] == 'done'
+    assert queue.redis.get(queue._inflight_key(URL)) is None
+    assert queue.redis.get(queue._waiting_key(URL)) is None
@@ -0,0 +1,22 @@
+from manifest import extract_book_links
+
+AUTHOR_PAGE = """<html><body>
+<a href="#top">Anfang</a>
+<a href="index.htm">Diese Seite</a>
+<a href="1848/manifest/index.htm">Manifest</a>
+<a href="1848/manifest/index.htm#kap1">Manifest, Kapitel 1</a>
+<a href="https://www.marxists.org/deutsch/archiv/marx-engels/1848/manifest/">Manifest again</a>
+<a href="1867\\kapital\\index.htm">Kapital</a>
+<a href="1867/kapital/kap01.htm">Kapitel 1</a>
+<a href="../lenin/1917/staat/index.htm">Lenin</a>
+<a href="../../themen/index.htm">Themen</a>
+<a href="mailto:someone@example.org">Mail</a>
+</body></html>"""
+
+
+def test_author_page():
+    base = "http://www.marxists.org/deutsch/archiv/marx-engels/index.htm"
+    assert extract_book_links(AUTHOR_PAGE, base) == [
+        "http://www.marxists.org/deutsch/archiv/marx-engels/1848/manifest/index.htm",
+        "http://www.marxists.org/deutsch/archiv/marx-engels/1867/kapital/index.htm",
+    ]
@@ -0,0 +1,37 @@
+import io
+import os
+import zipfile
+
+from epubber import static_entries
+from zipwriter import DEFLATED, STORED, ZipWriter, compress
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def build(entries):
+    writer = ZipWriter(timestamp=0)
+    return b"".join(writer.add(entry) for entry in entries) + writer.finish()
+
+
+def test_epub_zip_is_valid():
+    head, styles = static_entries(ROOT, 6)
+    body = [compress('content.opf', '<package/>', 6),
+            compress('Text/Kapitel ä.xhtml', '<html>' + 'Text ' * 1000 + '</html>', 6),
+            compress('Images/a.png', b'\x89PNG\r\n\x1a\n' + bytes(100), 6, STORED)]
+    data = build(head + body + styles)
+    with zipfile.ZipFile(io.BytesIO(data)) as book:
+        assert book.testzip() is None
+        first = book.infolist()[0]
+        assert first.filename == 'mimetype' and first.compress_type == zipfile.ZIP_STORED
+        assert book.read('mimetype') == b'application/epub+zip'
+        assert book.getinfo('Text/Kapitel ä.xhtml').compress_type == zipfile.ZIP_DEFLATED
+        assert book.read('Text/Kapitel ä.xhtml').startswith(b'<html>Text ')
+    # Readers look for the mimetype right after the first local header
+    assert data[30:38] == b'mimetype' and data[38:58] == b'application/epub+zip'
+
+
+def test_empty_entry():
+    data = build([compress('mimetype', 'application/epub+zip', 6, STORED), compress('empty.txt', b'', 6, DEFLATED)])
+    with zipfile.ZipFile(io.BytesIO(data)) as book:
+        assert book.testzip() is None
+        assert book.read('empty.txt') == b''